@@ -0,0 +1,121 @@
+"""
+Compares CPU cost per concurrent stream of the two audio pipelines:
+
+  pcm   FFmpegPCMAudio decodes to PCM and every 20 ms frame is Opus-encoded in
+        this process, the way discord.py does it for non-Opus sources.
+  opus  FFmpegOpusAudio(codec='copy') remuxes the Opus packets without decoding.
+  frames  OpusFrameSource reads packets packed once by pack_opus_frames
+        (OPUS_FRAME_CACHE) from a memory-mapped file; no FFmpeg process at all.
+
+Usage:
+    python benchmarks/bench_audio_pipeline.py [--input track.webm] [--streams 1 4 8]
+
+Without --input a 60 second Opus test tone is generated with FFmpeg.
+Requires FFmpeg and libopus.
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import discord
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import OpusFrameSource, pack_opus_frames
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def make_test_track(ffmpeg, path):
+    subprocess.run(
+        [ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=60',
+         '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k', path],
+        check=True,
+    )
+
+
+def read_pcm(source, frames):
+    encoder = discord.opus.Encoder()
+    for _ in range(frames):
+        pcm = source.read()
+        if not pcm:
+            break
+        encoder.encode(pcm, encoder.SAMPLES_PER_FRAME)
+
+
+def read_opus(source, frames):
+    for _ in range(frames):
+        if not source.read():
+            break
+
+
+def run(path, ffmpeg, streams, frames, pipeline, frames_path):
+    if pipeline == 'pcm':
+        sources = [discord.FFmpegPCMAudio(path, executable=ffmpeg) for _ in range(streams)]
+        reader = read_pcm
+    elif pipeline == 'frames':
+        sources = [OpusFrameSource(frames_path) for _ in range(streams)]
+        reader = read_opus
+    else:
+        sources = [discord.FFmpegOpusAudio(path, codec='copy', executable=ffmpeg) for _ in range(streams)]
+        reader = read_opus
+
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=reader, args=(source, frames)) for source in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    # cleanup() waits on the FFmpeg children so their CPU time shows up in RUSAGE_CHILDREN.
+    for source in sources:
+        source.cleanup()
+    cpu = cpu_seconds() - cpu_before
+
+    audio_seconds = frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+    per_stream = cpu / streams
+    print(f"{pipeline:>6} | {streams:>7} | {wall:>7.2f}s | {cpu:>7.2f}s | {per_stream:>9.3f}s | {100 * per_stream / audio_seconds:>6.2f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help='Opus (webm/ogg) file to play; a test tone is generated if omitted')
+    parser.add_argument('--ffmpeg', default=shutil.which('ffmpeg') or os.path.join('bin', 'ffmpeg'))
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--frames', type=int, default=1500, help='20 ms frames read per stream')
+    args = parser.parse_args()
+
+    if not discord.opus.is_loaded() and not discord.opus._load_default():
+        raise SystemExit("libopus not found; the pcm pipeline needs it to encode frames")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.input
+        if not path:
+            path = os.path.join(tmp, 'tone.webm')
+            make_test_track(args.ffmpeg, path)
+
+        # Packing is a one-off cost per cached track, so it is not part of the measurement.
+        frames_path = os.path.join(tmp, 'track.opusframes')
+        pack_opus_frames(args.ffmpeg, path, frames_path, is_opus=True)
+
+        audio_seconds = args.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+        print(f"{args.frames} frames ({audio_seconds:.0f}s of audio) per stream from {path}")
+        print("  pipe | streams |    wall |     cpu | cpu/stream | cpu/audio-sec")
+        for streams in args.streams:
+            for pipeline in ('pcm', 'opus', 'frames'):
+                run(path, args.ffmpeg, streams, args.frames, pipeline, frames_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Microbenchmark for SongQueue against the plain list the queue used to be.
+
+Usage:
+    python benchmarks/bench_song_queue.py [--size 10000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import SongQueue
+
+
+def make_songs(size):
+    return [{'cache_key': f'Youtube-{i}', 'title': f'Song {i}', 'duration': 200} for i in range(size)]
+
+
+def list_queue(size):
+    return make_songs(size)
+
+
+def song_queue(size):
+    queue = SongQueue()
+    for song in make_songs(size):
+        queue.append(song)
+    return queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+    size, number = args.size, args.number
+    middle = size // 2
+    g = {'list_queue': list_queue, 'song_queue': song_queue, 'size': size, 'middle': middle}
+
+    def run(label, setup, stmt):
+        # One call per fresh queue so destructive operations always see the full size.
+        times = timeit.Timer(stmt, setup=setup, globals=g).repeat(repeat=number, number=1)
+        print(f"{label:<36} {sum(times) / number * 1e6:>10.2f} us")
+
+    print(f"{size} queued songs, {number} runs each")
+    run("list: advance (pop(0))", "q = list_queue(size)", "q.pop(0)")
+    run("SongQueue: advance (popleft)", "q = song_queue(size)", "q.popleft()")
+    run("list: requeue at front", "q = list_queue(size); s = q[0]", "q.insert(0, s)")
+    run("SongQueue: requeue at front", "q = song_queue(size); s = q[0]", "q.appendleft(s)")
+    run("list: find by id", "q = list_queue(size); key = q[-1]['cache_key']",
+        "next(s for s in q if s['cache_key'] == key)")
+    run("SongQueue: find by id", "q = song_queue(size); entry = q[-1]['entry_id']", "q.get(entry)")
+    run("list: remove middle", "q = list_queue(size)", "del q[middle]")
+    run("SongQueue: remove middle", "q = song_queue(size)", "q.remove_at(middle)")
+    run("list: move last to front", "q = list_queue(size)", "q.insert(0, q.pop())")
+    run("SongQueue: move last to front", "q = song_queue(size)", "q.move(size - 1, 0)")
+    run("list: skip to middle", "q = list_queue(size)", "del q[:middle]")
+    run("SongQueue: skip to middle", "q = song_queue(size)", "q.skip_to(middle)")
+    run("SongQueue: shuffle", "q = song_queue(size)", "q.shuffle()")
+
+
+if __name__ == '__main__':
+    main()
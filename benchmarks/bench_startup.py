@@ -0,0 +1,69 @@
+"""
+Cold-start import profile of main.py, taken with `python -X importtime`.
+
+Imports main in fresh interpreters and reports the median total import time
+and the slowest modules main imports directly. yt-dlp is imported lazily
+(on the first job, or pre-warmed after login), so its import cost is measured
+separately.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--top 15] [--profile importtime.txt]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(module):
+    """Returns [(depth, name, self_us, cumulative_us)] for one cold import of module."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return rows, result.stderr
+
+
+def total_us(rows, module):
+    return next(cumulative for depth, name, _, cumulative in rows if depth == 0 and name == module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--profile', help='write the raw -X importtime output of the last run here')
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.runs):
+        rows, raw = import_profile('main')
+        totals.append(total_us(rows, 'main'))
+    ytdl_totals = [total_us(import_profile('yt_dlp')[0], 'yt_dlp') for _ in range(args.runs)]
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            f.write(raw)
+
+    print(f"import main: {statistics.median(totals) / 1000:.1f} ms median of {args.runs} runs "
+          f"(min {min(totals) / 1000:.1f} ms)")
+    print(f"import yt_dlp (deferred): {statistics.median(ytdl_totals) / 1000:.1f} ms median")
+    print(f"yt_dlp loaded by import main: {'yes' if any(name == 'yt_dlp' for _, name, _, _ in rows) else 'no'}")
+    print()
+    print("Slowest direct imports of main (last run):")
+    direct = sorted((row for row in rows if row[0] == 1), key=lambda row: row[3], reverse=True)
+    for _, name, self_us, cumulative_us in direct[:args.top]:
+        print(f"  {name:<32} {cumulative_us / 1000:>8.1f} ms  (self {self_us / 1000:.1f} ms)")
+
+
+if __name__ == '__main__':
+    main()
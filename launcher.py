@@ -0,0 +1,223 @@
+"""
+Runs the bot as a cluster of worker processes, each one an AutoShardedBot
+that owns a contiguous block of shard ids. Each worker keeps all of its
+guilds' state in its own process, with its own CACHE_DIR
+(downloads/cluster-<id>). The launcher restarts workers that exit and serves
+a local IPC channel. Over that channel it collects stats for /cluster and
+forwards /restart_worker.
+
+Usage:
+    python launcher.py --workers 4 [--shards 16]
+
+Without --shards the shard count recommended by Discord is used.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import secrets
+import sys
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+class IPCConnection:
+    """
+    Newline-delimited JSON over a local TCP stream. Either side can send
+    requests ({"id", "op", ...}); replies carry "reply_to" and either "data"
+    or "error", and are matched to the waiting request by id.
+    """
+    LIMIT = 1024 * 1024
+
+    def __init__(self, reader, writer, handler):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self.ids = itertools.count(1)
+        self.waiting = {}
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        await self.writer.drain()
+
+    async def request(self, op, timeout=5, **fields):
+        request_id = next(self.ids)
+        reply = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = reply
+        try:
+            await self.send({"id": request_id, "op": op, **fields})
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def serve(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'reply_to' in message:
+                    reply = self.waiting.get(message['reply_to'])
+                    if reply and not reply.done():
+                        if 'error' in message:
+                            reply.set_exception(RuntimeError(message['error']))
+                        else:
+                            reply.set_result(message.get('data'))
+                elif 'id' in message:
+                    asyncio.get_running_loop().create_task(self.answer(message))
+        finally:
+            for reply in self.waiting.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError("IPC connection closed"))
+            self.writer.close()
+
+    async def answer(self, message):
+        try:
+            reply = {"reply_to": message['id'], "data": await self.handler(message)}
+        except Exception as e:
+            reply = {"reply_to": message['id'], "error": str(e)}
+        try:
+            await self.send(reply)
+        except ConnectionError:
+            pass
+
+
+class Worker:
+    def __init__(self, cluster_id, shard_ids):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.connection = None
+
+
+class Launcher:
+    def __init__(self, workers, shard_count):
+        self.shard_count = shard_count
+        self.token = secrets.token_hex(16)
+        self.address = None
+        self.stopping = False
+        self.workers = [
+            Worker(cluster_id, [shard for shard in range(shard_count) if shard * workers // shard_count == cluster_id])
+            for cluster_id in range(workers)
+        ]
+
+    async def run(self):
+        server = await asyncio.start_server(self.on_connect, '127.0.0.1', 0, limit=IPCConnection.LIMIT)
+        self.address = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+        print(f"[INFO] Launching {len(self.workers)} workers for {self.shard_count} shards, IPC on {self.address}")
+        async with server:
+            try:
+                await asyncio.gather(*(self.supervise(worker) for worker in self.workers))
+            finally:
+                self.stopping = True
+
+    async def supervise(self, worker):
+        cache_dir = os.path.join(os.environ.get("CACHE_DIR", "downloads"), f"cluster-{worker.cluster_id}")
+        env = dict(
+            os.environ,
+            SHARD_IDS=",".join(map(str, worker.shard_ids)),
+            SHARD_COUNT=str(self.shard_count),
+            CLUSTER_ID=str(worker.cluster_id),
+            CLUSTER_IPC=self.address,
+            CLUSTER_IPC_TOKEN=self.token,
+            CACHE_DIR=cache_dir,
+        )
+        failures = 0
+        try:
+            while not self.stopping:
+                started = time.monotonic()
+                print(f"[INFO] Starting worker {worker.cluster_id} (shards {worker.shard_ids})")
+                worker.process = await asyncio.create_subprocess_exec(sys.executable, MAIN, env=env)
+                code = await worker.process.wait()
+                worker.process = None
+                # A worker that dies right after starting is retried with a growing delay.
+                failures = failures + 1 if time.monotonic() - started < 60 else 0
+                delay = min(5 * failures, 60)
+                print(f"[ERROR] Worker {worker.cluster_id} exited with code {code}, restarting in {delay}s")
+                await asyncio.sleep(delay)
+        finally:
+            if worker.process and worker.process.returncode is None:
+                worker.process.terminate()
+                await worker.process.wait()
+
+    async def on_connect(self, reader, writer):
+        try:
+            hello = json.loads(await reader.readline())
+        except ValueError:
+            hello = {}
+        cluster_id = hello.get('cluster_id')
+        if (hello.get('token') != self.token or not isinstance(cluster_id, int)
+                or not 0 <= cluster_id < len(self.workers)):
+            writer.close()
+            return
+        worker = self.workers[cluster_id]
+        connection = IPCConnection(reader, writer, self.handle)
+        worker.connection = connection
+        try:
+            await connection.serve()
+        finally:
+            if worker.connection is connection:
+                worker.connection = None
+
+    async def handle(self, message):
+        if message['op'] == 'cluster_stats':
+            return await self.cluster_stats()
+        if message['op'] == 'restart_worker':
+            cluster_id = message.get('cluster_id')
+            if not isinstance(cluster_id, int) or not 0 <= cluster_id < len(self.workers):
+                return False
+            connection = self.workers[cluster_id].connection
+            if connection is None:
+                return False
+            return await connection.request('shutdown')
+        raise ValueError(f"unknown op {message['op']!r}")
+
+    async def cluster_stats(self):
+        async def worker_stats(worker):
+            if worker.connection is None:
+                return {"cluster_id": worker.cluster_id, "online": False}
+            try:
+                return dict(await worker.connection.request('stats'), online=True)
+            except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+                return {"cluster_id": worker.cluster_id, "online": False}
+
+        return await asyncio.gather(*(worker_stats(worker) for worker in self.workers))
+
+
+async def recommended_shards(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+
+async def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shards', type=int, help='total shard count (default: recommended by Discord)')
+    args = parser.parse_args()
+
+    shard_count = args.shards
+    if not shard_count:
+        token = os.environ.get("DISCORD_TOKEN")
+        if not token:
+            raise SystemExit("DISCORD_TOKEN is not set")
+        shard_count = await recommended_shards(token)
+    workers = max(1, min(args.workers, shard_count))
+    await Launcher(workers, shard_count).run()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
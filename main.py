@@ -1,243 +1,2462 @@
 import discord
 from discord.ext import commands
 import asyncio
-import yt_dlp as youtube_dl
 import os
 import json
+import hashlib
 import platform
-import urllib.request
-import zipfile
-import tarfile
 import shutil
 from dotenv import load_dotenv
 import urllib.parse
+import time
+import shlex
+import re
+import uuid
+import random
+import itertools
+import sqlite3
+import concurrent.futures
+import mmap
+import struct
+import subprocess
+import threading
+from collections import deque, OrderedDict, namedtuple
+
+load_dotenv()
 
 # --- FFmpeg Setup ---
+# FFMPEG_PATH (or an ffmpeg on PATH) is used as it is; only when neither exists is a
+# static build downloaded into ./bin. The archive is checked against FFMPEG_SHA256 when
+# it is pinned, otherwise against the checksum the build host publishes next to it.
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH")
+FFMPEG_SHA256 = os.environ.get("FFMPEG_SHA256", "").lower()
+FFMPEG_BUILDS = {
+    "Windows": (
+        "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip",
+        "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip.sha256", "sha256",
+    ),
+    "Linux": (
+        "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz",
+        "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz.md5", "md5",
+    ),
+}
+FFMPEG_DOWNLOAD_ATTEMPTS = 3
+
+def probe_ffmpeg(ffmpeg_path, cache_path):
+    """
+    Returns the version line of `ffmpeg -version`, or None if the binary does not
+    run. Results are cached per path, size and mtime, so later starts skip the probe.
+    """
+    try:
+        stat = os.stat(ffmpeg_path)
+    except OSError:
+        return None
+    key = os.path.realpath(ffmpeg_path)
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            probes = json.load(f)
+    except (OSError, ValueError):
+        probes = {}
+    cached = probes.get(key)
+    if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+        return cached['version']
+
+    try:
+        output = subprocess.run(
+            [ffmpeg_path, '-hide_banner', '-version'], capture_output=True, text=True, timeout=10, check=True
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    version = output.splitlines()[0] if output else "ffmpeg"
+    probes[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "version": version}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(probes, f)
+    except OSError:
+        pass
+    return version
+
+def download_with_resume(url, path):
+    """
+    Downloads url to path + '.part', resuming a partial file left by an earlier
+    attempt, and renames it to path when complete.
+    """
+    import urllib.error
+    import urllib.request
+
+    part_path = path + '.part'
+    for attempt in range(1, FFMPEG_DOWNLOAD_ATTEMPTS + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                if response.status != 206:
+                    offset = 0
+                total = response.length + offset if response.length is not None else None
+                if offset:
+                    print(f"[INFO] Resuming download at {offset // (1024 * 1024)} MB")
+                done = offset
+                reported = -1
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    while chunk := response.read(256 * 1024):
+                        f.write(chunk)
+                        done += len(chunk)
+                        if total and done * 10 // total != reported:
+                            reported = done * 10 // total
+                            print(f"[INFO] Downloading FFmpeg: {reported * 10}% ({done // (1024 * 1024)}/{total // (1024 * 1024)} MB)")
+            os.replace(part_path, path)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset:
+                # The partial file already holds the whole archive.
+                os.replace(part_path, path)
+                return
+            error = e
+        except OSError as e:
+            error = e
+        print(f"[ERROR] FFmpeg download attempt {attempt} failed: {error}")
+        if attempt < FFMPEG_DOWNLOAD_ATTEMPTS:
+            time.sleep(2 * attempt)
+    raise error
+
+def verify_ffmpeg_archive(path, checksum_url, algorithm):
+    import urllib.request
+
+    digest = hashlib.sha256()
+    published = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+            published.update(chunk)
+    sha256 = digest.hexdigest()
+    if FFMPEG_SHA256:
+        if sha256 != FFMPEG_SHA256:
+            raise ValueError(f"FFmpeg archive SHA-256 {sha256} does not match FFMPEG_SHA256")
+        return
+    with urllib.request.urlopen(checksum_url, timeout=30) as response:
+        expected = response.read().decode().split()[0].lower()
+    if published.hexdigest() != expected:
+        raise ValueError(f"FFmpeg archive {algorithm} {published.hexdigest()} does not match the published {expected}")
+    print(f"[INFO] FFmpeg archive verified; set FFMPEG_SHA256={sha256} to pin it")
+
+def extract_ffmpeg(archive_path, bin_dir):
+    import tarfile
+    import zipfile
+
+    names = ('ffmpeg', 'ffprobe', 'ffmpeg.exe', 'ffprobe.exe')
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            for member in zip_ref.infolist():
+                if os.path.basename(member.filename) in names:
+                    member.filename = os.path.basename(member.filename)
+                    zip_ref.extract(member, bin_dir)
+    else:
+        with tarfile.open(archive_path, 'r:xz') as tar_ref:
+            for member in tar_ref.getmembers():
+                if member.isfile() and os.path.basename(member.name) in names:
+                    member.name = os.path.basename(member.name)
+                    tar_ref.extract(member, bin_dir)
+                    os.chmod(os.path.join(bin_dir, member.name), 0o755)
+
 def setup_ffmpeg():
     """
-    Checks for FFmpeg and downloads it if not found into a local ./bin directory.
-    Returns the path to the FFmpeg executable.
+    Finds FFmpeg (FFMPEG_PATH, then PATH, then ./bin) or downloads it into ./bin.
+    Returns the path to the FFmpeg executable, or None. Blocking; main() runs it
+    in a thread while the bot logs in.
     """
     bin_dir = os.path.join(os.getcwd(), "bin")
-    
-    if platform.system() == "Windows":
-        ffmpeg_path = os.path.join(bin_dir, "ffmpeg.exe")
+    probe_cache = os.path.join(bin_dir, "ffmpeg-probe.json")
+    executable = "ffmpeg.exe" if platform.system() == "Windows" else "ffmpeg"
+    ffmpeg_path = os.path.join(bin_dir, executable)
+
+    for candidate in (FFMPEG_PATH, shutil.which("ffmpeg"), ffmpeg_path):
+        if not candidate:
+            continue
+        version = probe_ffmpeg(candidate, probe_cache)
+        if version:
+            print(f"[INFO] Using {version} at {candidate}")
+            return candidate
+        if candidate == FFMPEG_PATH:
+            print(f"[ERROR] FFMPEG_PATH {candidate} is not a working FFmpeg")
+
+    build = FFMPEG_BUILDS.get(platform.system())
+    if build is None:
+        print(f"[FATAL] Unsupported operating system: {platform.system()}")
+        return None
+    if platform.system() == "Linux" and platform.machine() != "x86_64":
+        print(f"[FATAL] Unsupported Linux architecture '{platform.machine()}'. Please install FFmpeg manually.")
+        return None
+
+    url, checksum_url, algorithm = build
+    archive_path = os.path.join(bin_dir, "ffmpeg.zip" if url.endswith('.zip') else "ffmpeg.tar.xz")
+    print(f"[INFO] FFmpeg not found, downloading from {url}...")
+    os.makedirs(bin_dir, exist_ok=True)
+    try:
+        download_with_resume(url, archive_path)
+        verify_ffmpeg_archive(archive_path, checksum_url, algorithm)
+        print("[INFO] Download complete. Extracting...")
+        extract_ffmpeg(archive_path, bin_dir)
+    except ValueError as e:
+        # A corrupt or tampered archive is not resumed from on the next start.
+        print(f"[FATAL] {e}")
+        return None
+    except Exception as e:
+        print(f"[FATAL] Error downloading/extracting FFmpeg: {e}")
+        return None
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+    version = probe_ffmpeg(ffmpeg_path, probe_cache)
+    if not version:
+        print(f"[FATAL] Downloaded FFmpeg at {ffmpeg_path} does not run")
+        return None
+    print(f"[INFO] FFmpeg setup complete: {version}")
+    return ffmpeg_path
+
+# --- Bot Code ---
+
+# SHARDING "auto" runs an AutoShardedBot with Discord's recommended shard count in this
+# process. launcher.py instead runs several worker processes and gives each one its
+# SHARD_IDS out of SHARD_COUNT, plus the address of its local IPC channel.
+SHARDING = os.environ.get("SHARDING", "off")
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 0)) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ.get("SHARD_IDS", "").split(",") if shard_id]
+CLUSTER_ID = int(os.environ.get("CLUSTER_ID", 0))
+CLUSTER_IPC = os.environ.get("CLUSTER_IPC")
+CLUSTER_IPC_TOKEN = os.environ.get("CLUSTER_IPC_TOKEN")
+
+# The bot only needs guilds, voice states and message content (for prefix commands).
+# "minimal" subscribes to exactly those, "default" adds discord.py's default intents,
+# and "full" restores Intents.all() with every member cached.
+INTENTS_PROFILE = os.environ.get("INTENTS_PROFILE", "minimal")
+MAX_MESSAGES = int(os.environ.get("MAX_MESSAGES", 100)) or None
+# Rough per-object sizes, only used for the startup estimate of the memory saved.
+MEMBER_CACHE_BYTES = 2048
+MESSAGE_CACHE_BYTES = 3072
+DEFAULT_MAX_MESSAGES = 1000
+
+def build_intents(profile):
+    if profile == "full":
+        return discord.Intents.all(), discord.MemberCacheFlags.all()
+    if profile == "default":
+        intents = discord.Intents.default()
+    elif profile == "minimal":
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
     else:
-        ffmpeg_path = os.path.join(bin_dir, "ffmpeg")
+        raise ValueError(f"Unknown INTENTS_PROFILE {profile!r}; expected minimal, default or full")
+    intents.voice_states = True
+    intents.message_content = True
+    # Only members sitting in a voice channel are cached; everyone else arrives with
+    # the message or interaction that needs them.
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    return intents, member_cache_flags
+
+intents, member_cache_flags = build_intents(INTENTS_PROFILE)
+bot_options = dict(
+    command_prefix='!',
+    intents=intents,
+    member_cache_flags=member_cache_flags,
+    max_messages=MAX_MESSAGES,
+    chunk_guilds_at_startup=intents.members,
+)
+if SHARDING == "auto" or SHARD_COUNT:
+    bot = commands.AutoShardedBot(**bot_options, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+else:
+    bot = commands.Bot(**bot_options)
+
+def log_cache_savings():
+    """
+    Estimates what the intents profile saves compared to Intents.all(): members
+    that are not cached, plus the smaller message cache.
+    """
+    if INTENTS_PROFILE == "full":
+        return
+    total_members = sum(guild.member_count or 0 for guild in bot.guilds)
+    cached_members = sum(len(guild.members) for guild in bot.guilds)
+    skipped_members = max(total_members - cached_members, 0)
+    skipped_messages = DEFAULT_MAX_MESSAGES - min(MAX_MESSAGES or 0, DEFAULT_MAX_MESSAGES)
+    saved = skipped_members * MEMBER_CACHE_BYTES + skipped_messages * MESSAGE_CACHE_BYTES
+    print(
+        f"[INFO] Intents profile '{INTENTS_PROFILE}': {cached_members}/{total_members} members cached, "
+        f"message cache {MAX_MESSAGES or 0}; ~{saved / (1024 * 1024):.1f} MB saved compared to Intents.all()"
+    )
+
+# yt-dlp never starts FFmpeg itself: the MP3 conversion of the mp3 pipeline runs as a
+# background transcode under the FFmpeg budget (see postprocess_download), and container
+# fixups are skipped because FFmpeg plays the unfixed audio files just as well.
+ydl_opts = {
+    'format': 'bestaudio/best',
+    'fixup': 'never',
+    'outtmpl': 'downloads/%(id)s.%(ext)s',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+}
+
+# AUDIO_PIPELINE "opus" keeps the source container and sends Opus audio to Discord without
+# re-encoding (FFmpeg only remuxes it); non-Opus sources are encoded to Opus by FFmpeg.
+# "mp3" is the old pipeline: transcode to MP3, decode to PCM, encode to Opus in Python.
+AUDIO_PIPELINE = os.environ.get("AUDIO_PIPELINE", "opus")
+
+if AUDIO_PIPELINE == "opus":
+    ydl_opts['format'] = 'bestaudio[acodec=opus]/bestaudio/best'
+
+# Per-guild limits; a guild's player is dropped entirely once it goes idle.
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 500))
+MAX_HISTORY_SIZE = int(os.environ.get("MAX_HISTORY_SIZE", 50))
+
+# yt-dlp runs on a worker pool so it never blocks the event loop.
+# YTDL_POOL is "thread" or "process"; YTDL_WORKERS caps concurrent jobs process-wide.
+YTDL_POOL = os.environ.get("YTDL_POOL", "thread")
+YTDL_WORKERS = int(os.environ.get("YTDL_WORKERS", 4))
+# A user with YTDL_USER_MAX_PENDING yt-dlp jobs queued or running is asked to wait before
+# the next /play. YTDL_RATE_LIMIT_KB caps download bandwidth for the whole process (0 = no cap).
+YTDL_USER_MAX_PENDING = int(os.environ.get("YTDL_USER_MAX_PENDING", 4))
+YTDL_RATE_LIMIT_KB = int(os.environ.get("YTDL_RATE_LIMIT_KB", 0))
+
+# PLAYBACK_MODE "download" waits for the full file before playing; "stream" feeds the
+# direct media URL to FFmpeg and starts almost immediately. With STREAM_CACHE enabled the
+# file is still downloaded into the audio cache in the background so replays come from disk.
+PLAYBACK_MODE = os.environ.get("PLAYBACK_MODE", "download")
+STREAM_CACHE = os.environ.get("STREAM_CACHE", "0") == "1"
+# Direct media URLs expire; re-resolve queued entries older than this (seconds).
+STREAM_URL_TTL = int(os.environ.get("STREAM_URL_TTL", 3600))
+FFMPEG_RECONNECT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+# Downloaded tracks are kept in CACHE_DIR until it grows past CACHE_MAX_MB.
+CACHE_DIR = os.environ.get("CACHE_DIR", "downloads")
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", 2048))
+# With OPUS_FRAME_CACHE downloads are stored as ready-to-send Opus packets, so a cached
+# track plays without starting FFmpeg at all.
+OPUS_FRAME_CACHE = os.environ.get("OPUS_FRAME_CACHE", "0") == "1"
+
+# The slash-command schema hash of the last successful sync, per scope ("global" or a
+# guild id). on_ready only syncs when the hash changes. DEV_GUILD_IDS additionally get
+# the commands as guild commands, which update instantly while developing.
+COMMAND_SYNC_FILE = os.environ.get("COMMAND_SYNC_FILE", os.path.join(CACHE_DIR, "command_sync.json"))
+DEV_GUILD_IDS = [int(guild_id) for guild_id in os.environ.get("DEV_GUILD_IDS", "").split(",") if guild_id]
+
+# Resolved search queries and URLs are remembered in SQLite; entries older than
+# METADATA_TTL seconds are still used but refreshed in the background.
+METADATA_DB = os.environ.get("METADATA_DB", os.path.join(CACHE_DIR, "metadata.sqlite3"))
+METADATA_TTL = int(os.environ.get("METADATA_TTL", 86400))
+
+# While a song plays, the next PREFETCH_COUNT queued songs are downloaded (or, in stream
+# mode, resolved). Prefetches use at most YTDL_WORKERS - 1 workers so one is always
+# left for on-demand requests.
+PREFETCH_COUNT = int(os.environ.get("PREFETCH_COUNT", 2))
+
+# Seconds the bot stays in the voice channel after the queue runs out.
+IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", 60))
+
+# The now-playing message is edited in place. Updates are coalesced for
+# NOW_PLAYING_DEBOUNCE seconds and written at most once per NOW_PLAYING_MIN_INTERVAL,
+# well inside Discord's per-channel edit limit. Once NOW_PLAYING_RESEND_AFTER other
+# messages have been posted below it, a fresh message is sent instead.
+NOW_PLAYING_DEBOUNCE = 0.5
+NOW_PLAYING_MIN_INTERVAL = 1.5
+NOW_PLAYING_RESEND_AFTER = int(os.environ.get("NOW_PLAYING_RESEND_AFTER", 10))
+
+QUEUE_PAGE_SIZE = 10
+
+# Playlists are read with flat extraction in batches: a small first batch so playback
+# starts right away, then PLAYLIST_BATCH_SIZE entries at a time up to PLAYLIST_MAX_ITEMS.
+PLAYLIST_FIRST_BATCH = 5
+PLAYLIST_BATCH_SIZE = int(os.environ.get("PLAYLIST_BATCH_SIZE", 100))
+PLAYLIST_MAX_ITEMS = int(os.environ.get("PLAYLIST_MAX_ITEMS", 500))
+# Minimum seconds between edits of the playlist progress message.
+PLAYLIST_PROGRESS_INTERVAL = 3
+
+# /radio decodes a station once and fans the packets out to every guild tuned in.
+# A station keeps the last BROADCAST_BUFFER_FRAMES 20 ms packets; listeners start
+# BROADCAST_LISTENER_DELAY packets behind live, and one that falls out of the buffer
+# (a paused or stalled connection) skips ahead instead of holding the others back.
+BROADCAST_BUFFER_FRAMES = 250
+BROADCAST_LISTENER_DELAY = 10
+
+# Queues, current songs and play history are saved to QUEUE_DB every QUEUE_SAVE_INTERVAL
+# seconds. With RESUME_ON_START the bot rejoins the saved voice channels after a restart
+# and continues the current song where it stopped.
+QUEUE_DB = os.environ.get("QUEUE_DB", os.path.join(CACHE_DIR, "queues.sqlite3"))
+QUEUE_SAVE_INTERVAL = int(os.environ.get("QUEUE_SAVE_INTERVAL", 5))
+RESUME_ON_START = os.environ.get("RESUME_ON_START", "1") == "1"
+# Saved queue entries are read back this many at a time.
+QUEUE_RESTORE_BATCH = 200
+
+# At most FFMPEG_MAX_PROCESSES FFmpeg processes run at once (0 = four per CPU core), each
+# limited to FFMPEG_THREADS threads. Playback decoders get free slots first; background
+# transcodes (MP3 conversion, Opus frame packing) also queue behind FFMPEG_TRANSCODE_WORKERS
+# (0 = half the cores) and only start when no playback is waiting.
+FFMPEG_MAX_PROCESSES = int(os.environ.get("FFMPEG_MAX_PROCESSES", 0)) or (os.cpu_count() or 1) * 4
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", 1))
+FFMPEG_TRANSCODE_WORKERS = int(os.environ.get("FFMPEG_TRANSCODE_WORKERS", 0)) or max(1, (os.cpu_count() or 2) // 2)
+
+
+# --- yt-dlp worker pool ---
+# The job functions live at module level so they can be pickled for a process pool.
+# yt-dlp is slow to import (it loads every extractor), so it is imported by the first
+# job, or ahead of time by YTDLPool.prewarm once the bot has logged in.
+
+def ytdl_prewarm():
+    import yt_dlp
+
+def ytdl_extract_info(opts, query):
+    import yt_dlp
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(query, download=False)
+        return ydl.sanitize_info(info)
+
+def ytdl_download(opts, url):
+    import yt_dlp
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.download([url])
+
+def format_duration(seconds):
+    if not seconds:
+        return "Неизвестно"
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def stream_fields(video_info):
+    """
+    Picks the direct media URL and the HTTP headers FFmpeg needs to fetch it
+    out of an extract_info result.
+    """
+    return {
+        "stream_url": video_info.get('url'),
+        "stream_headers": video_info.get('http_headers') or {},
+        "stream_resolved_at": time.time(),
+    }
+
+# Job priorities: the song about to play, then prefetches, then playlist fills and
+# other background work. Jobs of one priority are taken round-robin by guild, then
+# by user within the guild.
+PRIORITY_PLAY = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_BULK = 2
+
+JobTag = namedtuple('JobTag', 'priority guild_id user')
+BACKGROUND_JOB = JobTag(PRIORITY_BULK, None, None)
+
+def _timed_job(func, args):
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+
+class YTDLPool:
+    """
+    Runs yt-dlp jobs on a thread or process pool and records how long jobs wait
+    for a free worker and how long they take to run.
+
+    Jobs are handed to the executor only when a worker is free. Until then
+    they wait in per-priority queues of guilds, each holding per-user queues,
+    and the next job is taken from the front guild and user of the most urgent
+    non-empty priority, both of which then move to the back. One user's
+    200-song playlist then takes turns with everyone else instead of running
+    ahead of them.
+    """
+    def __init__(self, kind=YTDL_POOL, max_workers=YTDL_WORKERS):
+        if kind == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdl")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.warmed = False
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+        self.running = 0
+        self.queues = [OrderedDict() for _ in (PRIORITY_PLAY, PRIORITY_PREFETCH, PRIORITY_BULK)]
+        self.waiting = [0, 0, 0]
+        self.queued_by_key = {}
+        self.user_pending = {}
+
+    async def run(self, func, *args, tag=BACKGROUND_JOB, key=None, on_start=None):
+        """
+        Runs func(*args) on a worker once the scheduler gives this job its turn,
+        calling on_start() just before it is handed over. A job submitted with a
+        key can later be moved up with promote().
+        """
+        loop = asyncio.get_running_loop()
+        submitted = time.time()
+        self.pending += 1
+        self.user_pending[tag.user] = self.user_pending.get(tag.user, 0) + 1
+        try:
+            await self.wait_turn(tag, key)
+            if on_start:
+                on_start()
+            job = loop.run_in_executor(self.executor, _timed_job, func, args)
+            # The worker is handed on when the job really ends, even if nobody waits for it any more.
+            job.add_done_callback(self.job_done)
+            result, started, finished = await asyncio.shield(job)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            count = self.user_pending.pop(tag.user) - 1
+            if count:
+                self.user_pending[tag.user] = count
+
+        waited = started - submitted
+        elapsed = finished - started
+        self.completed += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.exec_total += elapsed
+        self.exec_max = max(self.exec_max, elapsed)
+        print(f"[DEBUG] yt-dlp {func.__name__}: waited {waited:.2f}s, ran {elapsed:.2f}s ({self.pending} pending)")
+        return result
+
+    async def wait_turn(self, tag, key):
+        if self.running < self.max_workers and not any(self.waiting):
+            self.running += 1
+            return
+        turn = asyncio.get_running_loop().create_future()
+        self.enqueue(turn, tag, key)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # Given a worker just as we were cancelled; pass it on.
+                self.release_worker()
+            else:
+                self.discard(turn, tag, key)
+            raise
+
+    def enqueue(self, turn, tag, key):
+        users = self.queues[tag.priority].setdefault(tag.guild_id, OrderedDict())
+        users.setdefault(tag.user, deque()).append((turn, tag, key))
+        self.waiting[tag.priority] += 1
+        if key is not None:
+            self.queued_by_key[key] = (turn, tag)
+
+    def discard(self, turn, tag, key):
+        guilds = self.queues[tag.priority]
+        users = guilds.get(tag.guild_id)
+        entries = users.get(tag.user) if users else None
+        entry = (turn, tag, key)
+        if not entries or entry not in entries:
+            return
+        entries.remove(entry)
+        if not entries:
+            del users[tag.user]
+        if not users:
+            del guilds[tag.guild_id]
+        self.waiting[tag.priority] -= 1
+        if key is not None and self.queued_by_key.get(key, (None,))[0] is turn:
+            del self.queued_by_key[key]
+
+    def promote(self, key, priority):
+        """
+        Moves a queued job up to priority, e.g. when a prefetch turns out to be
+        the song that has to play now.
+        """
+        queued = self.queued_by_key.get(key)
+        if queued is None or queued[1].priority <= priority:
+            return
+        turn, tag = queued
+        self.discard(turn, tag, key)
+        self.enqueue(turn, tag._replace(priority=priority), key)
+
+    def next_turn(self):
+        for priority, guilds in enumerate(self.queues):
+            if not guilds:
+                continue
+            guild_id, users = next(iter(guilds.items()))
+            user, entries = next(iter(users.items()))
+            turn, tag, key = entries.popleft()
+            if entries:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                guilds.move_to_end(guild_id)
+            else:
+                del guilds[guild_id]
+            self.waiting[priority] -= 1
+            if key is not None and self.queued_by_key.get(key, (None,))[0] is turn:
+                del self.queued_by_key[key]
+            return turn
+        return None
+
+    def release_worker(self):
+        self.running -= 1
+        while self.running < self.max_workers:
+            turn = self.next_turn()
+            if turn is None:
+                break
+            if turn.cancelled():
+                continue
+            self.running += 1
+            turn.set_result(None)
+
+    def job_done(self, job):
+        if not job.cancelled():
+            # Marks the exception as retrieved when the caller has stopped waiting.
+            job.exception()
+        self.release_worker()
+
+    def stats(self):
+        done = max(self.completed, 1)
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "pending": self.pending,
+            "waiting": list(self.waiting),
+            "users": len(self.user_pending),
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_avg": self.wait_total / done,
+            "wait_max": self.wait_max,
+            "exec_avg": self.exec_total / done,
+            "exec_max": self.exec_max,
+        }
+
+    def prewarm(self):
+        """
+        Imports yt-dlp before the first job needs it: on a spare thread for the
+        thread pool, where the import is shared, and in each worker for the
+        process pool.
+        """
+        if self.warmed:
+            return
+        self.warmed = True
+        if self.kind == "process":
+            for _ in range(self.max_workers):
+                self.executor.submit(ytdl_prewarm)
+        else:
+            threading.Thread(target=ytdl_prewarm, name="ytdl-prewarm", daemon=True).start()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# --- FFmpeg budget ---
+
+class FFmpegSlot:
+    """
+    One admitted FFmpeg process. release() may be called from any thread
+    (audio sources are cleaned up on discord.py's audio thread) and more
+    than once.
+    """
+    def __init__(self, budget, priority):
+        self.budget = budget
+        self.priority = priority
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.budget.loop.call_soon_threadsafe(self.budget.release, self.priority)
+        except RuntimeError:
+            # The event loop is already closed during shutdown.
+            pass
+
+
+class FFmpegBudget:
+    """
+    Process-wide admission control for FFmpeg processes. A process starts
+    only once it holds a slot; live playback decoders are always admitted
+    before waiting background transcodes, and background transcodes are
+    additionally capped at max_background.
+    """
+    LIVE = 0
+    BACKGROUND = 1
+
+    def __init__(self, max_processes=FFMPEG_MAX_PROCESSES, max_background=FFMPEG_TRANSCODE_WORKERS):
+        self.max_processes = max_processes
+        self.max_background = max_background
+        self.running = [0, 0]
+        self.waiters = (deque(), deque())
+        self.loop = None
+
+    def can_start(self, priority):
+        if sum(self.running) >= self.max_processes:
+            return False
+        return priority == self.LIVE or self.running[self.BACKGROUND] < self.max_background
+
+    async def acquire(self, priority):
+        self.loop = asyncio.get_running_loop()
+        # Background work never overtakes anything already waiting.
+        ahead = self.waiters[self.LIVE] or (priority == self.BACKGROUND and self.waiters[self.BACKGROUND])
+        if not ahead and self.can_start(priority):
+            self.running[priority] += 1
+            return FFmpegSlot(self, priority)
+
+        waiter = self.loop.create_future()
+        self.waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we were cancelled; hand the slot on.
+                self.release(priority)
+            elif waiter in self.waiters[priority]:
+                self.waiters[priority].remove(waiter)
+            raise
+        return FFmpegSlot(self, priority)
+
+    def release(self, priority):
+        self.running[priority] -= 1
+        for waiting_priority in (self.LIVE, self.BACKGROUND):
+            waiters = self.waiters[waiting_priority]
+            while waiters and self.can_start(waiting_priority):
+                waiter = waiters.popleft()
+                if waiter.cancelled():
+                    continue
+                self.running[waiting_priority] += 1
+                waiter.set_result(None)
+            if waiters:
+                break
+
+    def stats(self):
+        return {
+            "max": self.max_processes,
+            "live_running": self.running[self.LIVE],
+            "live_waiting": len(self.waiters[self.LIVE]),
+            "background_running": self.running[self.BACKGROUND],
+            "background_waiting": len(self.waiters[self.BACKGROUND]),
+        }
+
+
+# --- Audio cache ---
+
+def cache_key(video_info):
+    key = f"{video_info.get('extractor_key', 'generic')}-{video_info['id']}"
+    return re.sub(r'[^\w.-]', '_', key)
+
+
+class AudioCache:
+    """
+    Downloaded tracks in downloads/, keyed by extractor and video id, kept under
+    CACHE_MAX_MB by evicting the least recently played files first.
+
+    Files are downloaded into downloads/.tmp and renamed into place, so a path
+    returned by get() is always complete. Tracks that are currently playing are
+    pinned and never evicted.
+    """
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.tmp_directory = os.path.join(directory, '.tmp')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Anything left in .tmp is a download interrupted by a crash.
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+
+        for key, entry in sorted(saved.items(), key=lambda item: item[1]['last_used']):
+            path = os.path.join(self.directory, entry['file'])
+            if os.path.exists(path):
+                entry['size'] = os.path.getsize(path)
+                self.entries[key] = entry
+                self.total_bytes += entry['size']
+        print(f"[INFO] Audio cache: {len(self.entries)} files, {self.total_bytes / 1024 / 1024:.1f} MB")
+        self.evict()
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def peek(self, key):
+        entry = self.entries.get(key)
+        return os.path.join(self.directory, entry['file']) if entry else None
+
+    def get(self, key):
+        path = self.peek(key)
+        if path and not os.path.exists(path):
+            self.remove(key)
+            path = None
+        if path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.entries[key]['last_used'] = time.time()
+        return path
+
+    def new_tmp_dir(self):
+        path = os.path.join(self.tmp_directory, uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    def insert(self, key, tmp_dir):
+        """
+        Moves the single finished file in tmp_dir into the cache under key.
+        """
+        files = [name for name in os.listdir(tmp_dir) if not name.endswith(('.part', '.ytdl'))]
+        if len(files) != 1:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise RuntimeError(f"expected one downloaded file for {key}, found {files}")
+
+        filename = key + os.path.splitext(files[0])[1]
+        path = os.path.join(self.directory, filename)
+        os.replace(os.path.join(tmp_dir, files[0]), path)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)['size']
+        size = os.path.getsize(path)
+        self.entries[key] = {'file': filename, 'size': size, 'last_used': time.time()}
+        self.total_bytes += size
+        self.evict()
+        self.save()
+        return path
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry['size']
+        try:
+            os.remove(os.path.join(self.directory, entry['file']))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[ERROR] Could not remove cached file {entry['file']}: {e}")
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key in self.pinned:
+                continue
+            print(f"[DEBUG] Evicting from audio cache: {key}")
+            self.remove(key)
+            self.evictions += 1
+        self.save()
+
+    def acquire(self, key):
+        self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def release(self, key):
+        count = self.pinned.get(key, 0) - 1
+        if count > 0:
+            self.pinned[key] = count
+        else:
+            self.pinned.pop(key, None)
+            self.evict()
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {
+            "files": len(self.entries),
+            "size_mb": self.total_bytes / 1024 / 1024,
+            "max_mb": self.max_bytes / 1024 / 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups,
+            "evictions": self.evictions,
+        }
+
+
+# --- Opus frame cache ---
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+OPUS_FRAMES_EXT = '.opusframes'
+
+def pack_opus_frames(ffmpeg, src, dst, is_opus):
+    """
+    Writes the audio in src to dst as 20 ms Opus packets, each prefixed with
+    its length as a little-endian uint16. Opus input is remuxed, anything
+    else is encoded once here instead of on every replay. Returns the number
+    of packets written.
+    """
+    if is_opus:
+        codec = ['-c:a', 'copy']
+    else:
+        codec = ['-c:a', 'libopus', '-b:a', '128k', '-frame_duration', '20', '-ar', '48000', '-ac', '2']
+    process = subprocess.Popen(
+        [ffmpeg, '-nostdin', '-loglevel', 'error', '-i', src, '-map', '0:a:0', *codec,
+         '-threads', str(FFMPEG_THREADS), '-f', 'opus', 'pipe:1'],
+        stdout=subprocess.PIPE,
+    )
+    frames = 0
+    try:
+        with open(dst, 'wb') as f:
+            for packet in discord.oggparse.OggStream(process.stdout).iter_packets():
+                if packet.startswith((b'OpusHead', b'OpusTags')):
+                    continue
+                f.write(struct.pack('<H', len(packet)))
+                f.write(packet)
+                frames += 1
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0 or frames == 0:
+        raise RuntimeError(f"FFmpeg exited with {returncode} after {frames} Opus packets")
+    return frames
+
+
+def transcode_mp3(ffmpeg, src, dst):
+    """
+    The mp3 pipeline's conversion, formerly yt-dlp's FFmpegExtractAudio postprocessor.
+    """
+    subprocess.run(
+        [ffmpeg, '-nostdin', '-loglevel', 'error', '-i', src, '-vn', '-c:a', 'libmp3lame', '-b:a', '192k',
+         '-threads', str(FFMPEG_THREADS), dst],
+        check=True,
+    )
+
+
+class OpusFrameSource(discord.AudioSource):
+    """
+    Plays a file written by pack_opus_frames through a read-only memory map.
+    Every read() is one length lookup and one slice; there is no subprocess
+    and nothing to decode or encode.
+    """
+    def __init__(self, path, offset=0):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+        for _ in range(int(offset / FRAME_SECONDS)):
+            if not self.read():
+                break
+
+    def read(self):
+        if self.map is None or self.pos + 2 > len(self.map):
+            return b''
+        (size,) = struct.unpack_from('<H', self.map, self.pos)
+        start = self.pos + 2
+        self.pos = start + size
+        return self.map[start:self.pos]
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+# --- Metadata cache ---
+
+def canonical_url(url):
+    parsed = urllib.parse.urlparse(url.strip())
+    host = re.sub(r'^(www\.|m\.|music\.)', '', parsed.netloc.lower())
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    elif host == 'youtube.com':
+        if parsed.path == '/watch':
+            video_id = urllib.parse.parse_qs(parsed.query).get('v', [None])[0]
+        elif parsed.path.startswith(('/shorts/', '/live/', '/embed/')):
+            video_id = parsed.path.split('/')[2]
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return urllib.parse.urlunparse(parsed._replace(fragment=''))
+
+def is_playlist_url(url):
+    url = url.strip()
+    # Plain search text such as "AC/DC /playlist best of" is never a playlist.
+    if not url.startswith('http'):
+        return False
+    parsed = urllib.parse.urlparse(url)
+    params = urllib.parse.parse_qs(parsed.query)
+    if 'list' in params and 'v' not in params:
+        return True
+    return '/playlist' in parsed.path or '/sets/' in parsed.path
+
+def normalize_query(search_query):
+    if search_query.startswith('ytsearch:'):
+        return 'ytsearch:' + ' '.join(search_query[len('ytsearch:'):].lower().split())
+    return canonical_url(search_query)
+
+
+class MetadataCache:
+    """
+    SQLite table mapping normalized search queries and canonical URLs to the
+    fields play_music needs, so a repeated /play skips yt-dlp extraction.
+    Like QueueStore it runs in WAL mode and only on its own thread, so lookups
+    and commits never block the event loop.
+    """
+    FIELDS = ('id', 'extractor_key', 'title', 'duration', 'webpage_url', 'acodec')
+
+    def __init__(self, path=METADATA_DB, ttl=METADATA_TTL):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='metadata-cache')
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "key TEXT PRIMARY KEY, id TEXT NOT NULL, extractor_key TEXT, title TEXT, "
+            "duration INTEGER, webpage_url TEXT NOT NULL, acodec TEXT, updated_at REAL NOT NULL)"
+        )
+        self.db.commit()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def get(self, key):
+        """
+        Returns (video_info, is_stale) or None.
+        """
+        row = self.db.execute(
+            f"SELECT {', '.join(self.FIELDS)}, updated_at FROM metadata WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        video_info = dict(zip(self.FIELDS, row))
+        return video_info, time.time() - row[-1] > self.ttl
+
+    def put(self, key, video_info):
+        values = tuple(video_info.get(field) for field in self.FIELDS)
+        now = time.time()
+        for row_key in {key, canonical_url(video_info['webpage_url'])}:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO metadata (key, {', '.join(self.FIELDS)}, updated_at) "
+                f"VALUES (?, {', '.join('?' * len(self.FIELDS))}, ?)",
+                (row_key, *values, now),
+            )
+        self.db.commit()
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {
+            "entries": self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups,
+            "refreshes": self.refreshes,
+        }
+
+    def close(self):
+        self.executor.submit(self.db.close)
+        self.executor.shutdown(wait=True)
+
+
+# --- Queue persistence ---
+
+# Queue ids are handed out again on restore and direct media URLs will have
+# expired by then, so neither is saved.
+TRANSIENT_SONG_KEYS = ('entry_id', 'stream_url', 'stream_headers', 'stream_resolved_at')
+
+def persisted_song(song_data):
+    return {key: value for key, value in song_data.items() if key not in TRANSIENT_SONG_KEYS}
+
+
+class QueueStore:
+    """
+    Per-guild playback state in SQLite (WAL mode), so queues survive a restart
+    or crash. The connection is only used from the store's own thread: the cog
+    collects snapshots on the event loop and hands them over in one batch, and
+    the JSON encoding and the transaction happen here.
+    """
+    def __init__(self, path=QUEUE_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue-store')
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS players ("
+            "guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER, "
+            "current_song TEXT, elapsed REAL NOT NULL DEFAULT 0, loop INTEGER NOT NULL DEFAULT 0, "
+            "history TEXT NOT NULL DEFAULT '[]', updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS queue_entries ("
+            "guild_id INTEGER NOT NULL, idx INTEGER NOT NULL, song TEXT NOT NULL, "
+            "PRIMARY KEY (guild_id, idx));"
+        )
+        self.db.commit()
+        self.writes = 0
+        self.write_time = 0.0
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def write(self, deleted, snapshots):
+        """
+        Applies one batch in a single transaction. A snapshot without a queue
+        only updates the playback position.
+        """
+        started = time.perf_counter()
+        now = time.time()
+        with self.db:
+            for guild_id in deleted:
+                self.db.execute("DELETE FROM players WHERE guild_id = ?", (guild_id,))
+                self.db.execute("DELETE FROM queue_entries WHERE guild_id = ?", (guild_id,))
+            for snapshot in snapshots:
+                guild_id = snapshot['guild_id']
+                if 'queue' not in snapshot:
+                    self.db.execute(
+                        "UPDATE players SET elapsed = ?, updated_at = ? WHERE guild_id = ?",
+                        (snapshot['elapsed'], now, guild_id),
+                    )
+                    continue
+                current_song = snapshot['current_song']
+                self.db.execute(
+                    "INSERT OR REPLACE INTO players (guild_id, voice_channel_id, text_channel_id, "
+                    "current_song, elapsed, loop, history, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (guild_id, snapshot['voice_channel_id'], snapshot['text_channel_id'],
+                     json.dumps(current_song) if current_song else None, snapshot['elapsed'],
+                     int(snapshot['loop']), json.dumps(snapshot['history']), now),
+                )
+                self.db.execute("DELETE FROM queue_entries WHERE guild_id = ?", (guild_id,))
+                self.db.executemany(
+                    "INSERT INTO queue_entries (guild_id, idx, song) VALUES (?, ?, ?)",
+                    ((guild_id, idx, json.dumps(song)) for idx, song in enumerate(snapshot['queue'])),
+                )
+        self.writes += 1
+        self.write_time += time.perf_counter() - started
+
+    def load_players(self):
+        rows = self.db.execute(
+            "SELECT guild_id, voice_channel_id, text_channel_id, current_song, elapsed, loop, history, "
+            "(SELECT COUNT(*) FROM queue_entries q WHERE q.guild_id = players.guild_id) FROM players"
+        ).fetchall()
+        return [{
+            'guild_id': guild_id,
+            'voice_channel_id': voice_channel_id,
+            'text_channel_id': text_channel_id,
+            'current_song': json.loads(current_song) if current_song else None,
+            'elapsed': elapsed,
+            'loop': bool(loop),
+            'history': json.loads(history),
+            'queued': queued,
+        } for guild_id, voice_channel_id, text_channel_id, current_song, elapsed, loop, history, queued in rows]
+
+    def load_queue(self, guild_id, start, count):
+        rows = self.db.execute(
+            "SELECT song FROM queue_entries WHERE guild_id = ? AND idx >= ? ORDER BY idx LIMIT ?",
+            (guild_id, start, count),
+        ).fetchall()
+        return [json.loads(song) for (song,) in rows]
+
+    def stats(self):
+        return {
+            "guilds": self.db.execute("SELECT COUNT(*) FROM players").fetchone()[0],
+            "writes": self.writes,
+            "write_avg": self.write_time / max(self.writes, 1),
+        }
+
+    def close(self):
+        # Queued behind any pending write on the store's thread.
+        self.executor.submit(self.db.close)
+        self.executor.shutdown(wait=True)
+
+
+class MusicControls(discord.ui.View):
+    """
+    Persistent controls: one instance is registered with bot.add_view at startup
+    and attached to every now-playing message. The fixed custom_ids keep the
+    buttons working across restarts, and each click finds its guild's player
+    through interaction.guild_id.
+    """
+    def __init__(self, cog):
+        super().__init__(timeout=None)
+        self.cog = cog
+
+    @discord.ui.button(label="⏯️", style=discord.ButtonStyle.secondary, custom_id="music:pause_resume")
+    async def pause_resume(self, interaction: discord.Interaction, button: discord.ui.Button):
+        player = self.cog.players.get(interaction.guild_id)
+        if not player or not player.voice_client:
+            await interaction.response.send_message("❌ Бот не в голосовом канале!", ephemeral=True)
+            return
+        if player.voice_client.is_paused():
+            player.voice_client.resume()
+            await interaction.response.send_message("▶️ Воспроизведение возобновлено!", ephemeral=True)
+        else:
+            player.voice_client.pause()
+            await interaction.response.send_message("⏸️ Воспроизведение приостановлено!", ephemeral=True)
+
+    @discord.ui.button(label="⏭️", style=discord.ButtonStyle.secondary, custom_id="music:skip")
+    async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
+        player = self.cog.players.get(interaction.guild_id)
+        if player and player.voice_client and player.voice_client.is_playing():
+            player.voice_client.stop()
+            await interaction.response.send_message("⏭️ Песня пропущена!", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ Нечего пропускать!", ephemeral=True)
+
+    @discord.ui.button(label="⏮️", style=discord.ButtonStyle.secondary, custom_id="music:previous")
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        await self.cog.previous_song(interaction)
+
+    @discord.ui.button(label="⏹️", style=discord.ButtonStyle.danger, custom_id="music:stop")
+    async def stop_playback(self, interaction: discord.Interaction, button: discord.ui.Button):
+        player = self.cog.players.get(interaction.guild_id)
+        if player and player.voice_client:
+            await self.cog.shutdown_player(player)
+            await interaction.response.send_message("⏹️ Воспроизведение остановлено и очередь очищена!", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ Бот не в голосовом канале!", ephemeral=True)
+
+
+class SongQueue:
+    """
+    Song queue backed by a deque. Advancing, requeueing at the front and
+    appending are O(1); every entry gets a queue id with an O(1) lookup.
+    Positional access is the trade-off: indexing, remove and move walk the
+    deque from the nearer end, O(min(i, n - i)), so in the middle of a long
+    queue they are slower than on a plain list. skip_to slices once but still
+    untracks the ids on the smaller side, O(min(k, n - k)), where a list just
+    deletes the slice.
+
+    total_duration is kept up to date on every add and remove, so it never
+    needs a walk over the queue. version changes on every mutation and tells
+    the queue store whether there is anything new to save.
+    """
+    _next_id = itertools.count(1)
+
+    def __init__(self):
+        self._items = deque()
+        self._by_id = {}
+        self.total_duration = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def _track(self, song):
+        self.version += 1
+        song['entry_id'] = next(self._next_id)
+        self._by_id[song['entry_id']] = song
+        self.total_duration += song.get('duration') or 0
+        return song
+
+    def _untrack(self, song):
+        self.version += 1
+        del self._by_id[song['entry_id']]
+        self.total_duration -= song.get('duration') or 0
+
+    def append(self, song):
+        self._items.append(self._track(song))
+
+    def appendleft(self, song):
+        self._items.appendleft(self._track(song))
+
+    def popleft(self):
+        song = self._items.popleft()
+        self._untrack(song)
+        return song
+
+    def set_duration(self, song, duration):
+        if song.get('entry_id') in self._by_id:
+            self.total_duration += (duration or 0) - (song.get('duration') or 0)
+            self.version += 1
+        song['duration'] = duration
+
+    def peek(self, count, start=0):
+        return list(itertools.islice(self._items, start, start + count))
+
+    def get(self, entry_id):
+        return self._by_id.get(entry_id)
+
+    def remove_at(self, index):
+        song = self._items[index]
+        del self._items[index]
+        self._untrack(song)
+        return song
+
+    def move(self, src, dst):
+        song = self._items[src]
+        del self._items[src]
+        self._items.insert(dst, song)
+        self.version += 1
+        return song
+
+    def skip_to(self, index):
+        """
+        Drops the first index songs so the song at index is next, in one pass:
+        the kept part is sliced out once and the version bumped once.
+        """
+        if index <= 0:
+            return
+        items = self._items
+        dropped = list(itertools.islice(items, index))
+        self._items = kept = deque(itertools.islice(items, index, None))
+        if len(kept) < len(dropped):
+            # Cheaper to index the songs that stay than to untrack the ones that go.
+            self._by_id = {song['entry_id']: song for song in kept}
+            self.total_duration = sum(song.get('duration') or 0 for song in kept)
+        else:
+            by_id = self._by_id
+            duration = 0
+            for song in dropped:
+                del by_id[song['entry_id']]
+                duration += song.get('duration') or 0
+            self.total_duration -= duration
+        self.version += 1
+
+    def remove_entries(self, entry_ids):
+        entry_ids = set(entry_ids)
+        kept = deque()
+        for song in self._items:
+            if song['entry_id'] in entry_ids:
+                self._untrack(song)
+            else:
+                kept.append(song)
+        self._items = kept
+
+    def shuffle(self):
+        items = list(self._items)
+        random.shuffle(items)
+        self._items = deque(items)
+        self.version += 1
+
+    def clear(self):
+        self._items.clear()
+        self._by_id.clear()
+        self.total_duration = 0
+        self.version += 1
+
+
+class QueueView(discord.ui.View):
+    """
+    Pages through a guild's queue. Only the visible page is formatted, and it
+    is re-read from the live queue on every click.
+    """
+    def __init__(self, cog, guild_id):
+        super().__init__(timeout=180)
+        self.cog = cog
+        self.guild_id = guild_id
+        self.page = 0
+        self.message = None
+
+    def render(self):
+        player = self.cog.players.get(self.guild_id)
+        queue = player.song_queue if player else SongQueue()
+        pages = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+        self.page = min(self.page, pages - 1)
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= pages - 1
+
+        embed = discord.Embed(title="🎶 Очередь песен", color=discord.Color.blue())
+        start = self.page * QUEUE_PAGE_SIZE
+        lines = [
+            f"{start + i + 1}. {song['title']} (`{format_duration(song.get('duration'))}`)"
+            for i, song in enumerate(queue.peek(QUEUE_PAGE_SIZE, start))
+        ]
+        embed.description = "\n".join(lines) or "Очередь пуста!"
+        embed.set_footer(
+            text=f"Страница {self.page + 1}/{pages} • Песен: {len(queue)} • Осталось: {format_duration(queue.total_duration)}"
+        )
+        return embed
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+
+class TrackedSource(discord.AudioSource):
+    """
+    Wraps an FFmpeg source and counts the 20 ms frames handed to the voice
+    client, so the playback position can be saved without asking FFmpeg.
+    """
+    def __init__(self, source, start_offset=0.0, on_cleanup=None):
+        self.source = source
+        self.start_offset = start_offset
+        self.on_cleanup = on_cleanup
+        self.frames = 0
+
+    def read(self):
+        data = self.source.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+        if self.on_cleanup:
+            self.on_cleanup()
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames * FRAME_SECONDS
+
+
+# --- Broadcast ---
+
+class BroadcastSource:
+    """
+    One upstream audio source shared by any number of voice connections.
+
+    A producer thread reads the upstream in real time and writes Opus packets
+    (encoding once if the upstream is PCM) into a fixed ring of
+    BROADCAST_BUFFER_FRAMES slots, so memory does not depend on the number of
+    listeners. Each BroadcastListener keeps its own cursor into the ring. When
+    the upstream ends it is opened again, which keeps a station on the air
+    until the last listener leaves.
+    """
+    SILENCE = b'\xf8\xff\xfe'
+
+    def __init__(self, name, open_upstream, on_empty=None, capacity=BROADCAST_BUFFER_FRAMES):
+        self.name = name
+        self.open_upstream = open_upstream
+        self.on_empty = on_empty
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        self.head = 0
+        self.cond = threading.Condition()
+        self.listeners = set()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.produce, name=f"broadcast-{name}", daemon=True)
+        self.underruns = 0
+        self.skipped = 0
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.closed.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def produce(self):
+        failures = 0
+        while not self.closed.is_set():
+            try:
+                upstream = self.open_upstream()
+            except Exception as e:
+                failures += 1
+                print(f"[ERROR] Broadcast {self.name}: could not open upstream: {e}")
+                self.closed.wait(min(5 * failures, 60))
+                continue
+            failures = 0
+            try:
+                self.pump(upstream)
+            except Exception as e:
+                print(f"[ERROR] Broadcast {self.name}: upstream failed: {e}")
+                self.closed.wait(1)
+            finally:
+                upstream.cleanup()
+        print(f"[DEBUG] Broadcast {self.name} stopped")
+
+    def pump(self, upstream):
+        encoder = None if upstream.is_opus() else discord.opus.Encoder()
+        next_at = time.perf_counter()
+        while not self.closed.is_set():
+            data = upstream.read()
+            if not data:
+                return
+            if encoder:
+                data = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            with self.cond:
+                self.ring[self.head % self.capacity] = data
+                self.head += 1
+                self.cond.notify_all()
+            next_at += FRAME_SECONDS
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Behind schedule: carry on from now rather than bursting to catch up.
+                next_at = time.perf_counter()
+
+    def join(self, listener):
+        with self.cond:
+            self.listeners.add(listener)
+            return max(self.head - BROADCAST_LISTENER_DELAY, 0)
+
+    def leave(self, listener):
+        with self.cond:
+            self.listeners.discard(listener)
+            empty = not self.listeners
+        if empty and self.on_empty:
+            self.on_empty(self)
+
+    def read(self, listener):
+        """
+        Called from each voice client's audio thread every 20 ms.
+        """
+        with self.cond:
+            if listener.cursor >= self.head and not self.closed.is_set():
+                self.cond.wait(FRAME_SECONDS)
+            if self.closed.is_set():
+                return b''
+            if listener.cursor >= self.head:
+                # Upstream is late; silence keeps the connection alive without ending playback.
+                self.underruns += 1
+                return self.SILENCE
+            if self.head - listener.cursor > self.capacity:
+                lag = self.head - listener.cursor
+                listener.cursor = self.head - BROADCAST_LISTENER_DELAY
+                self.skipped += lag - BROADCAST_LISTENER_DELAY
+            data = self.ring[listener.cursor % self.capacity]
+            listener.cursor += 1
+            return data
+
+    def stats(self):
+        return {
+            "listeners": len(self.listeners),
+            "underruns": self.underruns,
+            "skipped": self.skipped,
+        }
+
+
+class BroadcastListener(discord.AudioSource):
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.cursor = broadcast.join(self)
+
+    def read(self):
+        return self.broadcast.read(self)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.broadcast:
+            self.broadcast.leave(self)
+            self.broadcast = None
+
+
+class GuildPlayer:
+    """
+    Playback state for a single guild. The cog keeps one instance per guild id
+    and drops it once the player goes idle, so guilds never share a voice
+    connection or a queue.
+    """
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.voice_client = None
+        self.current_song = None
+        self.song_queue = SongQueue()
+        self.play_history = deque(maxlen=MAX_HISTORY_SIZE)
+        self.loop = False
+        self.last_channel_id = None
+        self.now_playing_message = None
+        self.now_playing_pending = None
+        self.now_playing_task = None
+        self.now_playing_last_write = 0.0
+        self.messages_since_now_playing = 0
+        self.prefetch_tasks = {}
+        self.playlist_task = None
+        self.task = None
+        self.idle_timer = None
+        self.disconnect_task = None
+        # Held while connecting, so concurrent commands share one voice handshake.
+        self.join_lock = asyncio.Lock()
+        self.track_finished = asyncio.Event()
+        self.playback_error = None
+        self.audio_source = None
+        # Bumped when the current song or history changes; with song_queue.version
+        # it tells the queue store whether this guild needs saving.
+        self.state_version = 0
+        self.saved_version = None
+        self.saved_elapsed = None
+        self.restoring = False
+        # Loads the rest of a saved queue after a restart. Kept apart from
+        # playlist_task so that a new playlist does not cut the restore short.
+        self.restore_task = None
+        self.radio = None
+
+    def elapsed(self):
+        if self.current_song is None or self.audio_source is None:
+            return 0.0
+        return self.audio_source.position
+
+    def track_ended(self, error):
+        self.playback_error = error
+        self.track_finished.set()
+
+    def cancel_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def cancel_prefetches(self):
+        for task in self.prefetch_tasks.values():
+            task.cancel()
+        self.prefetch_tasks.clear()
+
+    def cancel_playlist(self):
+        if self.playlist_task:
+            self.playlist_task.cancel()
+            self.playlist_task = None
+
+    def cancel_restore(self):
+        if self.restore_task:
+            self.restore_task.cancel()
+            self.restore_task = None
+
+    def is_idle(self):
+        return (self.voice_client is None and self.current_song is None and not self.song_queue
+                and self.radio is None and self.playlist_task is None and self.restore_task is None
+                and self.task is None
+                and self.idle_timer is None and self.disconnect_task is None)
+
+    async def delete_now_playing(self):
+        self.now_playing_pending = None
+        if self.now_playing_task:
+            self.now_playing_task.cancel()
+            self.now_playing_task = None
+        if self.now_playing_message:
+            try:
+                await self.now_playing_message.delete()
+            except discord.NotFound:
+                pass
+            self.now_playing_message = None
+
 
-    if os.path.exists(ffmpeg_path):
-        print(f"[DEBUG] FFmpeg found at: {ffmpeg_path}")
-        return ffmpeg_path
+class MusicBot(commands.Cog):
+    def __init__(self, bot, ffmpeg_setup):
+        self.bot = bot
+        # Resolved by setup_ffmpeg while the bot logs in; see wait_for_ffmpeg.
+        self.ffmpeg_setup = ffmpeg_setup
+        self.ffmpeg_executable = None
+        self.players = {}
+        self.controls = MusicControls(self)
+        self.ytdl_pool = YTDLPool()
+        self.inflight_downloads = {}
+        # Requests still waiting on each in-flight download, and the downloads that
+        # have reached a yt-dlp worker (and so always finish into the cache).
+        self.download_waiters = {}
+        self.started_downloads = set()
+        # The most urgent priority any request has asked for each in-flight download.
+        self.download_priority = {}
+        self.prefetch_slots = asyncio.Semaphore(max(1, YTDL_WORKERS - 1))
+        self.audio_cache = AudioCache()
+        self.ffmpeg_budget = FFmpegBudget()
+        self.metadata_cache = MetadataCache()
+        self.metadata_refreshes = {}
+        self.queue_store = QueueStore()
+        self.stations = {}
+        self.deleted_states = set()
+        self.persist_task = None
+        self.resumed = False
+        self.cluster = None
+        self.cluster_task = None
 
-    print("[INFO] FFmpeg not found, starting download...")
-    os.makedirs(bin_dir, exist_ok=True)
+    async def cog_load(self):
+        self.bot.add_view(self.controls)
+        self.persist_task = self.bot.loop.create_task(self.persist_loop())
+        if CLUSTER_IPC:
+            self.cluster_task = self.bot.loop.create_task(self.connect_cluster())
+
+    def cog_unload(self):
+        self.controls.stop()
+        for task in list(self.inflight_downloads.values()):
+            task.cancel()
+        self.ytdl_pool.shutdown()
+        self.audio_cache.save()
+        for task in list(self.metadata_refreshes.values()):
+            task.cancel()
+        self.metadata_cache.close()
+        if self.persist_task:
+            self.persist_task.cancel()
+        if self.cluster_task:
+            self.cluster_task.cancel()
+        deleted, snapshots, _ = self.collect_queue_state()
+        self.queue_store.executor.submit(self.queue_store.write, deleted, snapshots)
+        self.queue_store.close()
+        for station in list(self.stations.values()):
+            station.close()
+
+    def ydl_options(self):
+        local_ydl_opts = ydl_opts.copy()
+        if self.ffmpeg_executable:
+            local_ydl_opts['ffmpeg_location'] = os.path.dirname(self.ffmpeg_executable)
+        return local_ydl_opts
+
+    async def wait_for_ffmpeg(self):
+        if self.ffmpeg_executable is None:
+            self.ffmpeg_executable = await asyncio.shield(self.ffmpeg_setup)
+            if self.ffmpeg_executable is None:
+                raise RuntimeError("FFmpeg is not available")
+        return self.ffmpeg_executable
+
+    def job_tag(self, priority, guild_id, song_data=None):
+        return JobTag(priority, guild_id, song_data.get('requester') if song_data else None)
+
+    async def extract_video(self, key, search_query, tag):
+        info = await self.ytdl_pool.run(ytdl_extract_info, self.ydl_options(), search_query, tag=tag)
+        if 'entries' in info:
+            if not info['entries']:
+                return None
+            info = info['entries'][0]
+        await self.metadata_cache.run(self.metadata_cache.put, key, info)
+        return info
+
+    async def lookup_video(self, search_query, tag):
+        """
+        Resolves a search query or URL to video info, from the metadata cache
+        when possible. Returns None if a search finds nothing.
+        """
+        key = normalize_query(search_query)
+        cached = await self.metadata_cache.run(self.metadata_cache.get, key)
+        if cached is None:
+            return await self.extract_video(key, search_query, tag)
+
+        video_info, stale = cached
+        if stale and key not in self.metadata_refreshes:
+            async def refresh():
+                try:
+                    await self.extract_video(key, search_query, tag._replace(priority=PRIORITY_BULK))
+                    self.metadata_cache.refreshes += 1
+                except Exception as e:
+                    print(f"[ERROR] Metadata refresh failed for {key}: {e}")
+                finally:
+                    self.metadata_refreshes.pop(key, None)
+
+            self.metadata_refreshes[key] = self.bot.loop.create_task(refresh())
+        print(f"[DEBUG] Metadata cache hit for {key}{' (stale)' if stale else ''}")
+        return video_info
+
+    async def resolve_stream(self, song_data, tag):
+        resolved_at = song_data.get('stream_resolved_at', 0)
+        if song_data.get('stream_url') and time.time() - resolved_at < STREAM_URL_TTL:
+            return
+        print(f"[DEBUG] Resolving stream URL for: {song_data['title']}")
+        info = await self.ytdl_pool.run(ytdl_extract_info, self.ydl_options(), song_data['webpage_url'], tag=tag)
+        song_data.update(stream_fields(info))
 
-    if platform.system() == "Windows":
-        url = "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip"
-        zip_path = os.path.join(bin_dir, "ffmpeg.zip")
-        
+    async def fetch_to_cache(self, song_data, tag):
+        key = song_data['cache_key']
+        tmp_dir = self.audio_cache.new_tmp_dir()
+        local_ydl_opts = self.ydl_options()
+        local_ydl_opts['outtmpl'] = os.path.join(tmp_dir, '%(id)s.%(ext)s')
+        if YTDL_RATE_LIMIT_KB:
+            # An equal share per worker keeps the total under the cap however many downloads run.
+            local_ydl_opts['ratelimit'] = YTDL_RATE_LIMIT_KB * 1024 // YTDL_WORKERS
         try:
-            print(f"[INFO] Downloading from {url}...")
-            urllib.request.urlretrieve(url, zip_path)
-            print("[INFO] Download complete. Extracting...")
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                for member in zip_ref.infolist():
-                    if member.filename.endswith('ffmpeg.exe') or member.filename.endswith('ffprobe.exe'):
-                        member.filename = os.path.basename(member.filename)
-                        zip_ref.extract(member, bin_dir)
-            os.remove(zip_path)
-            print("[INFO] FFmpeg setup complete.")
-            return ffmpeg_path
-        except Exception as e:
-            print(f"[FATAL] Error downloading/extracting FFmpeg: {e}")
-            return None
+            await self.ytdl_pool.run(
+                ytdl_download, local_ydl_opts, song_data['webpage_url'],
+                tag=tag, key=key, on_start=lambda: self.started_downloads.add(key),
+            )
+            await self.postprocess_download(tmp_dir, song_data)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return self.audio_cache.insert(key, tmp_dir)
 
-    elif platform.system() == "Linux":
-        arch = platform.machine()
-        if arch != "x86_64":
-            print(f"[FATAL] Unsupported Linux architecture '{arch}'. Please install FFmpeg manually.")
-            return None
+    async def postprocess_download(self, tmp_dir, song_data):
+        """
+        Replaces the file just downloaded into tmp_dir with its Opus frame file
+        (OPUS_FRAME_CACHE) or, on the mp3 pipeline, its MP3 conversion. Runs
+        under the FFmpeg budget: as live work when the song has to play now,
+        otherwise as a background transcode. If it fails the original file is
+        cached and played through FFmpeg as it is.
+        """
+        files = [name for name in os.listdir(tmp_dir) if not name.endswith(('.part', '.ytdl'))]
+        if len(files) != 1:
+            return
+        src = os.path.join(tmp_dir, files[0])
+        if OPUS_FRAME_CACHE:
+            dst = os.path.join(tmp_dir, song_data['cache_key'] + OPUS_FRAMES_EXT)
+            is_opus = song_data.get('acodec') == 'opus' and src.endswith(('.webm', '.ogg', '.opus'))
+            job = (pack_opus_frames, src, dst, is_opus)
+        elif AUDIO_PIPELINE == "mp3" and not src.endswith('.mp3'):
+            dst = os.path.join(tmp_dir, song_data['cache_key'] + '.mp3')
+            job = (transcode_mp3, src, dst)
+        else:
+            return
 
-        url = "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz"
-        tar_path = os.path.join(bin_dir, "ffmpeg.tar.xz")
-        
+        func, *args = job
+        ffmpeg = await self.wait_for_ffmpeg()
+        if self.download_priority.get(song_data['cache_key']) == PRIORITY_PLAY:
+            budget_priority = FFmpegBudget.LIVE
+        else:
+            budget_priority = FFmpegBudget.BACKGROUND
+        slot = await self.ffmpeg_budget.acquire(budget_priority)
         try:
-            print(f"[INFO] Downloading from {url}...")
-            urllib.request.urlretrieve(url, tar_path)
-            print("[INFO] Download complete. Extracting...")
-            with tarfile.open(tar_path, 'r:xz') as tar_ref:
-                for member in tar_ref.getmembers():
-                    if member.name.endswith('/ffmpeg'):
-                        member.name = os.path.basename(member.name)
-                        tar_ref.extract(member, bin_dir)
-                    elif member.name.endswith('/ffprobe'):
-                        member.name = os.path.basename(member.name)
-                        tar_ref.extract(member, bin_dir)
-            
-            os.chmod(ffmpeg_path, 0o755)
-            os.chmod(os.path.join(bin_dir, "ffprobe"), 0o755)
-
-            os.remove(tar_path)
-            print("[INFO] FFmpeg setup complete.")
-            return ffmpeg_path
+            await asyncio.get_running_loop().run_in_executor(None, func, ffmpeg, *args)
         except Exception as e:
-            print(f"[FATAL] Error downloading/extracting FFmpeg: {e}")
-            return None
-    
-    print(f"[FATAL] Unsupported operating system: {platform.system()}")
-    return None
+            print(f"[ERROR] Could not convert {song_data['title']} to {os.path.splitext(dst)[1]}: {e}")
+            if os.path.exists(dst):
+                os.remove(dst)
+            return
+        finally:
+            slot.release()
+        os.remove(src)
+        print(f"[DEBUG] Converted {song_data['cache_key']} to {os.path.splitext(dst)[1]}")
 
-# --- Bot Code ---
+    def start_download(self, song_data, tag):
+        """
+        Returns the in-flight download task for this track, starting one if
+        needed, so concurrent requests for the same video share one download.
+        A more urgent request moves the shared download up in the scheduler,
+        and a song that has to play now also gets its conversion run as live work.
+        """
+        key = song_data['cache_key']
+        task = self.inflight_downloads.get(key)
+        if task is None:
+            task = self.bot.loop.create_task(self.fetch_to_cache(song_data, tag))
+            self.inflight_downloads[key] = task
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='!', intents=intents)
+            def done(finished):
+                if self.inflight_downloads.get(key) is finished:
+                    del self.inflight_downloads[key]
+                    self.download_priority.pop(key, None)
+                    self.download_waiters.pop(key, None)
+                    self.started_downloads.discard(key)
 
-ydl_opts = {
-    'format': 'bestaudio/best',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '192',
-    }],
-    'outtmpl': 'downloads/%(id)s.%(ext)s',
-    'noplaylist': True,
-    'quiet': True,
-    'no_warnings': True,
-}
+            task.add_done_callback(done)
+        else:
+            print(f"[DEBUG] Joining in-flight download: {key}")
+            self.ytdl_pool.promote(key, tag.priority)
+        self.download_priority[key] = min(self.download_priority.get(key, tag.priority), tag.priority)
+        return task
 
-class MusicControls(discord.ui.View):
-    def __init__(self, cog):
-        super().__init__(timeout=None)
-        self.cog = cog
+    async def download_to_cache(self, song_data, tag):
+        """
+        Waits for the track's shared download. When the last waiter is cancelled
+        before the download reached a worker, the download is cancelled too; one
+        already running finishes into the cache.
+        """
+        key = song_data['cache_key']
+        cached_path = self.audio_cache.peek(key)
+        if cached_path:
+            return cached_path
+        task = self.start_download(song_data, tag)
+        self.download_waiters[key] = self.download_waiters.get(key, 0) + 1
+        try:
+            # Shielded so a cancelled waiter does not cancel the download for everyone else.
+            return await asyncio.shield(task)
+        finally:
+            if self.inflight_downloads.get(key) is task:
+                self.download_waiters[key] -= 1
+                if not self.download_waiters[key] and key not in self.started_downloads:
+                    task.cancel()
 
-    @discord.ui.button(label="⏯️", style=discord.ButtonStyle.secondary)
-    async def pause_resume(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.cog.voice_client.is_paused():
-            self.cog.voice_client.resume()
-            await interaction.response.send_message("▶️ Воспроизведение возобновлено!", ephemeral=True)
-        else:
-            self.cog.voice_client.pause()
-            await interaction.response.send_message("⏸️ Воспроизведение приостановлено!", ephemeral=True)
+    def cache_in_background(self, song_data, tag):
+        key = song_data['cache_key']
+        if self.audio_cache.peek(key):
+            return
 
-    @discord.ui.button(label="⏭️", style=discord.ButtonStyle.secondary)
-    async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.cog.voice_client and self.cog.voice_client.is_playing():
-            self.cog.voice_client.stop()
-            await interaction.response.send_message("⏭️ Песня пропущена!", ephemeral=True)
-        else:
-            await interaction.response.send_message("❌ Нечего пропускать!", ephemeral=True)
+        def report(task):
+            if task.cancelled():
+                return
+            if task.exception():
+                print(f"[ERROR] Background download failed for {song_data['title']}: {task.exception()}")
+            else:
+                print(f"[DEBUG] Cached in background: {key}")
 
-    @discord.ui.button(label="⏮️", style=discord.ButtonStyle.secondary)
-    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
-        await self.cog.previous_song(interaction)
+        task = self.start_download(song_data, tag._replace(priority=PRIORITY_BULK))
+        # A background download has no waiter that could leave, so it is never dropped.
+        self.download_waiters[key] = self.download_waiters.get(key, 0) + 1
+        task.add_done_callback(report)
 
-    @discord.ui.button(label="⏹️", style=discord.ButtonStyle.danger)
-    async def stop(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.cog.voice_client:
-            self.cog.song_queue = []
-            self.cog.loop = False
-            self.cog.voice_client.stop()
-            await self.cog.voice_client.disconnect()
-            self.cog.voice_client = None
-            self.cog.current_song = None
-            await interaction.response.send_message("⏹️ Воспроизведение остановлено и очередь очищена!", ephemeral=True)
-            if self.cog.now_playing_message:
-                try:
-                    await self.cog.now_playing_message.delete()
-                except discord.NotFound:
-                    pass
+    def create_audio_source(self, song_data, offset=0):
+        cached_path = self.audio_cache.peek(song_data['cache_key'])
+        if cached_path and cached_path.endswith(OPUS_FRAMES_EXT):
+            print(f"[DEBUG] Playing {song_data['title']} from packed Opus frames")
+            return OpusFrameSource(cached_path, offset)
+        if cached_path:
+            source = cached_path
+            before_options = None
         else:
-            await interaction.response.send_message("❌ Бот не в голосовом канале!", ephemeral=True)
+            source = song_data['stream_url']
+            before_options = FFMPEG_RECONNECT_OPTIONS
+            headers = "".join(f"{key}: {value}\r\n" for key, value in song_data.get('stream_headers', {}).items())
+            if headers:
+                before_options += f" -headers {shlex.quote(headers)}"
+        if offset:
+            # Input seeking, so FFmpeg skips ahead without decoding the skipped part.
+            before_options = f"-ss {offset:.2f}" + (f" {before_options}" if before_options else "")
 
+        options = f"-vn -threads {FFMPEG_THREADS}"
 
-class MusicBot(commands.Cog):
-    def __init__(self, bot, ffmpeg_executable):
-        self.bot = bot
-        self.ffmpeg_executable = ffmpeg_executable
-        self.voice_client = None
-        self.current_song = None
-        self.song_queue = []
-        self.play_history = []
-        self.loop = False
-        self.last_channel_id = None
-        self.now_playing_message = None
+        if AUDIO_PIPELINE == "mp3":
+            return discord.FFmpegPCMAudio(source, executable=self.ffmpeg_executable, before_options=before_options, options=options)
+
+        # A file cached by the mp3 pipeline is not Opus even if the source was.
+        is_opus = song_data.get('acodec') == 'opus'
+        if cached_path and not cached_path.endswith(('.webm', '.ogg', '.opus')):
+            is_opus = False
+        # FFmpegOpusAudio maps every Opus-looking codec name (including 'libopus') to
+        # '-c:a copy'; only codec=None makes it encode with libopus.
+        codec = 'copy' if is_opus else None
+        print(f"[DEBUG] Opus pipeline for {song_data['title']}: {'copy' if is_opus else 'encode to Opus'}")
+        return discord.FFmpegOpusAudio(
+            source,
+            codec=codec,
+            executable=self.ffmpeg_executable,
+            before_options=before_options,
+            options=options,
+        )
 
-    async def cleanup(self, filename):
+    async def open_audio_source(self, song_data, offset=0):
+        """
+        Creates the playback source, first taking a live slot from the FFmpeg
+        budget unless the track is packed Opus frames and needs no process.
+        The slot is handed back when discord.py cleans the source up.
+        """
+        cached_path = self.audio_cache.peek(song_data['cache_key'])
+        if cached_path and cached_path.endswith(OPUS_FRAMES_EXT):
+            return TrackedSource(self.create_audio_source(song_data, offset), offset)
+        await self.wait_for_ffmpeg()
+        slot = await self.ffmpeg_budget.acquire(FFmpegBudget.LIVE)
         try:
-            if os.path.exists(filename):
-                print(f"[DEBUG] Cleaning up file: {filename}")
-                os.remove(filename)
-        except Exception as e:
-            print(f"[ERROR] Error during cleanup: {e}")
-
-    async def after_playback(self, e):
-        if e:
-            print(f'[ERROR] Player error: {e}')
-
-        if self.current_song:
-            if not self.loop:
-                await self.cleanup(self.current_song['filename'])
-            self.play_history.append(self.current_song)
-
-        if self.loop and self.current_song:
-            self.song_queue.insert(0, self.current_song)
-
-        await self.play_next_song()
-
-    async def play_next_song(self):
-        if not self.song_queue:
-            self.current_song = None
-            if self.voice_client:
-                await asyncio.sleep(5)
-                if self.voice_client and not self.voice_client.is_playing():
-                    await self.voice_client.disconnect()
-                    self.voice_client = None
-            if self.now_playing_message:
+            source = self.create_audio_source(song_data, offset)
+        except BaseException:
+            slot.release()
+            raise
+        return TrackedSource(source, offset, on_cleanup=slot.release)
+
+    def get_player(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None:
+            player = GuildPlayer(guild_id)
+            self.players[guild_id] = player
+            print(f"[DEBUG] Created player for guild {guild_id} ({len(self.players)} active)")
+        return player
+
+    def release_player(self, player):
+        if player.is_idle() and self.players.get(player.guild_id) is player:
+            del self.players[player.guild_id]
+            self.deleted_states.add(player.guild_id)
+            print(f"[DEBUG] Released player for guild {player.guild_id} ({len(self.players)} active)")
+
+    async def ensure_metadata(self, player, song_data, tag):
+        """
+        Playlist entries are queued from flat extraction with only an id and a
+        title; the full metadata is looked up right before prefetch or playback.
+        """
+        if not song_data.get('needs_metadata'):
+            return
+        video_info = await self.lookup_video(song_data['webpage_url'], tag)
+        if video_info is None:
+            raise RuntimeError(f"no metadata for {song_data['webpage_url']}")
+        song_data['title'] = video_info.get('title') or song_data['title']
+        song_data['acodec'] = video_info.get('acodec')
+        if PLAYBACK_MODE == "stream" and video_info.get('url'):
+            song_data.update(stream_fields(video_info))
+        player.song_queue.set_duration(song_data, video_info.get('duration') or 0)
+        song_data.pop('needs_metadata', None)
+
+    async def prefetch(self, player, song_data):
+        tag = self.job_tag(PRIORITY_PREFETCH, player.guild_id, song_data)
+        await self.ensure_metadata(player, song_data, tag)
+        async with self.prefetch_slots:
+            if PLAYBACK_MODE == "stream":
+                await self.resolve_stream(song_data, tag)
+                if STREAM_CACHE:
+                    self.cache_in_background(song_data, tag)
+            else:
+                await self.download_to_cache(song_data, tag)
+        print(f"[DEBUG] Prefetched: {song_data['title']}")
+
+    def schedule_prefetch(self, player):
+        """
+        Keeps prefetch tasks running for exactly the next PREFETCH_COUNT queued songs.
+        Songs that left that window have their prefetch cancelled, which also
+        cancels a download still waiting for a yt-dlp worker unless another request
+        is waiting on it; a download that has already reached a worker still
+        finishes into the cache.
+        """
+        wanted = {song['cache_key']: song for song in player.song_queue.peek(PREFETCH_COUNT)}
+        for key in list(player.prefetch_tasks):
+            if key not in wanted:
+                player.prefetch_tasks.pop(key).cancel()
+
+        for key, song_data in wanted.items():
+            if key in player.prefetch_tasks or self.audio_cache.peek(key):
+                continue
+            task = self.bot.loop.create_task(self.prefetch(player, song_data))
+            player.prefetch_tasks[key] = task
+
+            def done(finished, key=key):
+                if player.prefetch_tasks.get(key) is finished:
+                    del player.prefetch_tasks[key]
+                if not finished.cancelled() and finished.exception():
+                    print(f"[ERROR] Prefetch failed for {key}: {finished.exception()}")
+
+            task.add_done_callback(done)
+
+    async def shutdown_player(self, player):
+        player.cancel_idle_timer()
+        if player.task:
+            player.task.cancel()
+            player.task = None
+        player.cancel_playlist()
+        player.cancel_restore()
+        player.song_queue.clear()
+        player.cancel_prefetches()
+        player.loop = False
+        player.radio = None
+        if player.current_song:
+            self.audio_cache.release(player.current_song['cache_key'])
+        player.current_song = None
+        if player.voice_client:
+            player.voice_client.stop()
+            await player.voice_client.disconnect()
+            player.voice_client = None
+        await player.delete_now_playing()
+        self.release_player(player)
+
+    def wake_player(self, player):
+        """
+        Tells the guild that its queue changed: cancels a pending idle disconnect
+        and starts the player loop if it is not running.
+        """
+        player.cancel_idle_timer()
+        if player.task is None or player.task.done():
+            player.task = self.bot.loop.create_task(self.player_loop(player))
+
+    async def player_loop(self, player):
+        """
+        Runs while the guild has songs to play and a voice connection, and is
+        the only place songs are started. The audio thread signals the end of a
+        song through call_soon_threadsafe and the loop waits for that signal
+        before advancing, so skips never recurse and can never advance twice.
+        """
+        try:
+            while player.song_queue:
+                if not player.voice_client or not player.voice_client.is_connected():
+                    # Kicked or disconnected: the queue waits for the next join instead of
+                    # being downloaded and skipped song by song.
+                    print(f"[INFO] Not connected to voice in guild {player.guild_id}, pausing the queue")
+                    break
                 try:
-                    await self.now_playing_message.delete()
-                except discord.NotFound:
-                    pass
+                    started = await self.start_next_song(player)
+                except Exception as e:
+                    import traceback
+                    print(f"[ERROR] Player loop error in guild {player.guild_id}: {e}")
+                    traceback.print_exc()
+                    started = False
+                if not started:
+                    self.finish_song(player, failed=True)
+                    continue
+
+                await player.track_finished.wait()
+                if player.playback_error:
+                    print(f'[ERROR] Player error in guild {player.guild_id}: {player.playback_error}')
+                self.finish_song(player)
+        finally:
+            if player.task is asyncio.current_task():
+                player.task = None
+        self.start_idle_timer(player)
+
+    def start_idle_timer(self, player):
+        """
+        Keeps the voice connection warm for IDLE_TIMEOUT seconds after the queue
+        runs out; anything queued in the meantime cancels the timer.
+        """
+        player.cancel_idle_timer()
+        player.idle_timer = self.bot.loop.call_later(IDLE_TIMEOUT, self.on_idle_timeout, player)
+
+    def on_idle_timeout(self, player):
+        player.idle_timer = None
+        if player.current_song or player.song_queue or player.task or player.radio:
+            return
+        voice_client = player.voice_client
+        player.voice_client = None
+        player.disconnect_task = self.bot.loop.create_task(self.disconnect_idle(player, voice_client))
+
+    async def disconnect_idle(self, player, voice_client):
+        try:
+            if voice_client:
+                print(f"[DEBUG] Idle for {IDLE_TIMEOUT}s, disconnecting from guild {player.guild_id}")
+                await voice_client.disconnect()
+            await player.delete_now_playing()
+        finally:
+            player.disconnect_task = None
+            self.release_player(player)
+
+    def finish_song(self, player, failed=False):
+        song_data = player.current_song
+        player.current_song = None
+        player.audio_source = None
+        if not song_data:
             return
+        player.state_version += 1
+        self.audio_cache.release(song_data['cache_key'])
+        player.play_history.append(song_data)
+        # A song that failed to start is not looped, or it would be retried forever.
+        if player.loop and not failed:
+            player.song_queue.appendleft(song_data)
+
+    def requeue_current(self, player, offset):
+        """
+        Puts the song that was being started back at the front of the queue.
+        """
+        song_data = player.current_song
+        player.current_song = None
+        player.state_version += 1
+        self.audio_cache.release(song_data['cache_key'])
+        if offset:
+            song_data['resume_offset'] = offset
+        player.song_queue.appendleft(song_data)
 
-        song_data = self.song_queue.pop(0)
-        self.current_song = song_data
+    async def start_next_song(self, player):
+        song_data = player.song_queue.popleft()
+        player.current_song = song_data
+        player.state_version += 1
+        offset = song_data.pop('resume_offset', 0)
+        self.audio_cache.acquire(song_data['cache_key'])
+        self.schedule_prefetch(player)
+        tag = self.job_tag(PRIORITY_PLAY, player.guild_id, song_data)
 
-        expected_filename = song_data["filename"]
+        try:
+            await self.ensure_metadata(player, song_data, tag)
+        except Exception as e:
+            print(f"[ERROR] Failed to resolve {song_data['title']}: {e}")
+            return False
         title = song_data["title"]
         duration = song_data["duration"]
-        
-        if not os.path.exists(expected_filename):
-            print(f"[ERROR] File not found for playback: {expected_filename}")
+
+        if not self.audio_cache.get(song_data['cache_key']):
             try:
-                with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([song_data['webpage_url']])
+                if PLAYBACK_MODE == "stream":
+                    await self.resolve_stream(song_data, tag)
+                    if STREAM_CACHE:
+                        self.cache_in_background(song_data, tag)
+                else:
+                    print(f"[DEBUG] Not cached, downloading: {title}")
+                    await self.download_to_cache(song_data, tag)
             except Exception as e:
-                print(f"[ERROR] Failed to re-download {title}: {e}")
-                await self.after_playback(None)
-                return
+                print(f"[ERROR] Failed to prepare {title}: {e}")
+                return False
 
-        print(f"[DEBUG] Starting playback of: {expected_filename}")
-        audio_source = discord.FFmpegPCMAudio(expected_filename, executable=self.ffmpeg_executable)
-        
-        self.voice_client.play(audio_source, after=lambda e: self.bot.loop.create_task(self.after_playback(e)))
+        if not player.voice_client or not player.voice_client.is_connected():
+            self.requeue_current(player, offset)
+            return False
+
+        print(f"[DEBUG] Starting playback of: {song_data['cache_key']} (guild {player.guild_id})")
+        audio_source = await self.open_audio_source(song_data, offset)
+        # Waiting for an FFmpeg slot can take a while; the connection may be gone by now.
+        if not player.voice_client or not player.voice_client.is_connected():
+            audio_source.cleanup()
+            self.requeue_current(player, offset)
+            return False
+        player.audio_source = audio_source
+
+        if player.radio:
+            # Queued music takes over from the radio.
+            player.radio = None
+            player.voice_client.stop()
+
+        player.track_finished.clear()
+        player.playback_error = None
+        try:
+            # The after callback runs on discord.py's audio thread.
+            player.voice_client.play(audio_source, after=lambda e: self.bot.loop.call_soon_threadsafe(player.track_ended, e))
+        except BaseException:
+            # discord.py never saw the source, so nothing else would hand back its FFmpeg slot.
+            player.audio_source = None
+            audio_source.cleanup()
+            raise
 
-        if self.last_channel_id:
-            channel = self.bot.get_channel(self.last_channel_id)
+        if player.last_channel_id:
+            channel = self.bot.get_channel(player.last_channel_id)
             if channel:
-                minutes, seconds = divmod(duration, 60)
-                duration_str = f"{minutes}:{seconds:02d}" if duration > 0 else "Неизвестно"
+                duration_str = format_duration(duration)
                 embed = discord.Embed(title="🎵 Сейчас играет", description=f"[{title}]({song_data['webpage_url']})", color=discord.Color.blue())
                 embed.add_field(name="Длительность", value=duration_str)
                 embed.add_field(name="Запросил", value=song_data['requester'])
-                
-                if self.now_playing_message:
-                    try:
-                        await self.now_playing_message.delete()
-                    except discord.NotFound:
-                        pass
 
-                self.now_playing_message = await channel.send(embed=embed, view=MusicControls(self))
+                self.update_now_playing(player, embed)
+        return True
+
+    def update_now_playing(self, player, embed):
+        """
+        Queues a now-playing update. Rapid track changes only produce one write
+        with the latest embed.
+        """
+        player.now_playing_pending = embed
+        if player.now_playing_task is None:
+            player.now_playing_task = self.bot.loop.create_task(self.now_playing_writer(player))
+
+    async def now_playing_writer(self, player):
+        try:
+            while player.now_playing_pending is not None:
+                next_write = player.now_playing_last_write + NOW_PLAYING_MIN_INTERVAL
+                await asyncio.sleep(max(NOW_PLAYING_DEBOUNCE, next_write - time.monotonic()))
+                embed = player.now_playing_pending
+                player.now_playing_pending = None
+                try:
+                    await self.write_now_playing(player, embed)
+                except discord.HTTPException as e:
+                    print(f"[ERROR] Could not update now-playing message in guild {player.guild_id}: {e}")
+                player.now_playing_last_write = time.monotonic()
+        finally:
+            if player.now_playing_task is asyncio.current_task():
+                player.now_playing_task = None
+
+    async def write_now_playing(self, player, embed):
+        channel = self.bot.get_channel(player.last_channel_id)
+        if channel is None:
+            return
+        message = player.now_playing_message
+        if (message and message.channel.id == channel.id
+                and player.messages_since_now_playing < NOW_PLAYING_RESEND_AFTER):
+            try:
+                await message.edit(embed=embed)
+                return
+            except discord.NotFound:
+                player.now_playing_message = None
+
+        # The old message is gone, in another channel or buried under the chat.
+        if player.now_playing_message:
+            try:
+                await player.now_playing_message.delete()
+            except discord.NotFound:
+                pass
+        player.now_playing_message = await channel.send(embed=embed, view=self.controls)
+        player.messages_since_now_playing = 0
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is None:
+            return
+        player = self.players.get(message.guild.id)
+        if (player and player.now_playing_message
+                and message.channel.id == player.now_playing_message.channel.id
+                and message.id != player.now_playing_message.id):
+            player.messages_since_now_playing += 1
+
+    async def persist_loop(self):
+        while True:
+            await asyncio.sleep(QUEUE_SAVE_INTERVAL)
+            deleted, snapshots, saved = self.collect_queue_state()
+            if not deleted and not snapshots:
+                continue
+            try:
+                await self.queue_store.run(self.queue_store.write, deleted, snapshots)
+            except Exception as e:
+                # Nothing is marked as saved, so the next round writes the same changes again.
+                print(f"[ERROR] Failed to save queue state: {e}")
+                self.deleted_states |= deleted
+                continue
+            for player, version, elapsed in saved:
+                player.saved_version = version
+                player.saved_elapsed = elapsed
+
+    def collect_queue_state(self):
+        """
+        Snapshots every player whose queue, current song or history changed
+        since the last save; a player that is only playing gets a position
+        update. Only the song dicts are copied here, everything else happens
+        on the store's thread. Also returns the (player, version, elapsed)
+        snapshotted, to be marked as saved once the write succeeds.
+        """
+        deleted, self.deleted_states = self.deleted_states, set()
+        snapshots = []
+        saved = []
+        for player in self.players.values():
+            # Saving a half-restored queue would overwrite the rest of it.
+            if player.restoring:
+                continue
+            version = (player.song_queue.version, player.state_version)
+            elapsed = player.elapsed()
+            if version != player.saved_version:
+                voice_client = player.voice_client
+                snapshots.append({
+                    'guild_id': player.guild_id,
+                    'voice_channel_id': voice_client.channel.id if voice_client and voice_client.channel else None,
+                    'text_channel_id': player.last_channel_id,
+                    'current_song': persisted_song(player.current_song) if player.current_song else None,
+                    'elapsed': elapsed,
+                    'loop': player.loop,
+                    'history': [persisted_song(song) for song in player.play_history],
+                    'queue': [persisted_song(song) for song in player.song_queue],
+                })
+            elif player.current_song and elapsed != player.saved_elapsed:
+                snapshots.append({'guild_id': player.guild_id, 'elapsed': elapsed})
+            else:
+                continue
+            saved.append((player, version, elapsed))
+        return deleted, snapshots, saved
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.ytdl_pool.prewarm()
+        # on_ready fires again after every gateway reconnect; queues are restored once.
+        if self.resumed or not RESUME_ON_START:
+            return
+        self.resumed = True
+        try:
+            states = await self.queue_store.run(self.queue_store.load_players)
+        except Exception as e:
+            print(f"[ERROR] Failed to load saved queues: {e}")
+            return
+        for state in states:
+            try:
+                await self.resume_player(state)
+            except Exception as e:
+                print(f"[ERROR] Could not resume playback in guild {state['guild_id']}: {e}")
+
+    async def resume_player(self, state):
+        """
+        Rebuilds a guild's player from saved state and rejoins its voice channel.
+        The current song restarts at its saved offset. Queue entries keep the
+        metadata they were saved with, so nothing is re-resolved up front: the
+        first QUEUE_RESTORE_BATCH are loaded before playback starts and the rest
+        in the background.
+        """
+        guild = self.bot.get_guild(state['guild_id'])
+        if guild is None and not self.owns_guild(state['guild_id']):
+            # Another worker's guild; its state is left alone.
+            return
+        voice_channel = guild.get_channel(state['voice_channel_id']) if guild and state['voice_channel_id'] else None
+        if (not isinstance(voice_channel, (discord.VoiceChannel, discord.StageChannel))
+                or not (state['current_song'] or state['queued'])):
+            self.deleted_states.add(state['guild_id'])
+            return
+
+        player = self.get_player(guild.id)
+        player.last_channel_id = state['text_channel_id']
+        player.loop = state['loop']
+        player.play_history.extend(state['history'])
+        player.restoring = True
+        if state['current_song']:
+            state['current_song']['resume_offset'] = state['elapsed']
+            player.song_queue.append(state['current_song'])
+        try:
+            restored = await self.restore_queue_batch(player, 0)
+            await self.join_channel(player, voice_channel)
+        except Exception:
+            player.restoring = False
+            self.abandon_queue(player, list(player.song_queue))
+            raise
+        self.wake_player(player)
+        print(f"[INFO] Resumed guild {guild.id}: {state['queued']} queued, current song at {state['elapsed']:.0f}s")
+
+        if restored < QUEUE_RESTORE_BATCH:
+            player.restoring = False
+        else:
+            player.restore_task = self.bot.loop.create_task(self.restore_queue(player, restored))
+
+    async def restore_queue_batch(self, player, start):
+        songs = await self.queue_store.run(self.queue_store.load_queue, player.guild_id, start, QUEUE_RESTORE_BATCH)
+        for song_data in songs:
+            if len(player.song_queue) >= MAX_QUEUE_SIZE:
+                break
+            player.song_queue.append(song_data)
+        self.schedule_prefetch(player)
+        return len(songs)
+
+    async def restore_queue(self, player, start):
+        try:
+            while len(player.song_queue) < MAX_QUEUE_SIZE:
+                restored = await self.restore_queue_batch(player, start)
+                start += restored
+                if restored < QUEUE_RESTORE_BATCH:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Queue restore stopped after {start} songs in guild {player.guild_id}: {e}")
+        finally:
+            player.restoring = False
+            if player.restore_task is asyncio.current_task():
+                player.restore_task = None
+                self.release_player(player)
+
+    def owns_guild(self, guild_id):
+        shard_count = self.bot.shard_count
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_count or shard_ids is None:
+            return True
+        return (guild_id >> 22) % shard_count in shard_ids
+
+    async def connect_cluster(self):
+        """
+        Keeps this worker connected to the launcher's IPC channel, reconnecting
+        if the channel drops.
+        """
+        from launcher import IPCConnection
+
+        host, port = CLUSTER_IPC.rsplit(':', 1)
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, int(port), limit=IPCConnection.LIMIT)
+                self.cluster = IPCConnection(reader, writer, self.handle_cluster_request)
+                await self.cluster.send({"op": "hello", "token": CLUSTER_IPC_TOKEN, "cluster_id": CLUSTER_ID})
+                print(f"[INFO] Connected to cluster launcher as worker {CLUSTER_ID}")
+                await self.cluster.serve()
+            except Exception as e:
+                # Includes malformed or oversized lines from serve(); CancelledError still propagates.
+                print(f"[ERROR] Cluster IPC connection failed: {e}")
+            finally:
+                self.cluster = None
+            await asyncio.sleep(5)
+
+    async def handle_cluster_request(self, message):
+        if message['op'] == 'stats':
+            return self.local_stats()
+        if message['op'] == 'shutdown':
+            # Answered first, so the launcher hears back before the connection closes.
+            self.bot.loop.create_task(self.shutdown_worker())
+            return True
+        raise ValueError(f"unknown op {message['op']!r}")
+
+    async def shutdown_worker(self):
+        await asyncio.sleep(1)
+        print("[INFO] Restart requested by the cluster launcher")
+        deleted, snapshots, _ = self.collect_queue_state()
+        await self.queue_store.run(self.queue_store.write, deleted, snapshots)
+        await self.bot.close()
+
+    def local_stats(self):
+        return {
+            "cluster_id": CLUSTER_ID,
+            "shard_ids": sorted(getattr(self.bot, 'shard_ids', None) or []),
+            "guilds": len(self.bot.guilds),
+            "players": len(self.players),
+            "voice": sum(1 for player in self.players.values() if player.voice_client),
+            "stations": len(self.stations),
+            "latency": self.bot.latency,
+            "ytdl_pending": self.ytdl_pool.pending,
+            "ffmpeg_running": sum(self.ffmpeg_budget.running),
+        }
 
     @commands.hybrid_command(name='play', description='Воспроизвести музыку с YouTube или добавить в очередь')
     async def play_music(self, ctx, *, query: str):
@@ -251,72 +2470,87 @@ class MusicBot(commands.Cog):
             await ctx.send("❌ У меня нет прав для подключения или воспроизведения аудио в этом канале!")
             return
 
+        player = self.players.get(ctx.guild.id)
+        if player and len(player.song_queue) >= MAX_QUEUE_SIZE:
+            await ctx.send(f"❌ Очередь заполнена (максимум {MAX_QUEUE_SIZE} песен)!")
+            return
+        if not await self.check_user_backlog(ctx):
+            return
+
         loading_msg = await ctx.send(f"🔄 Обработка запроса `{query}`...")
 
+        if is_playlist_url(query):
+            await self.play_playlist(ctx, voice_channel, query.strip(), loading_msg)
+            return
+
+        tag = JobTag(PRIORITY_PLAY, ctx.guild.id, ctx.author.mention)
+
         try:
-            os.makedirs('downloads', exist_ok=True)
-            local_ydl_opts = ydl_opts.copy()
-            local_ydl_opts['ffmpeg_location'] = os.path.dirname(self.ffmpeg_executable)
+            try:
+                is_url = query.strip().startswith('http')
+                search_query = query
 
-            with youtube_dl.YoutubeDL(local_ydl_opts) as ydl:
-                try:
-                    is_url = query.strip().startswith('http')
-                    search_query = query
-
-                    if is_url and 'youtube.com' in query and 'search_query' in query:
-                        parsed_url = urllib.parse.urlparse(query)
-                        search_query = urllib.parse.parse_qs(parsed_url.query)['search_query'][0]
-                        print(f"[DEBUG] Extracted search query from URL: '{search_query}'")
-                        search_query = f"ytsearch:{search_query}"
-                    elif not is_url:
-                        search_query = f"ytsearch:{query}"
-
-                    info = ydl.extract_info(search_query, download=False)
-
-                    if 'entries' in info:
-                        if not info['entries']:
-                            await loading_msg.edit(content=f"❌ Ничего не найдено по запросу: `{query}`")
-                            return
-                        video_info = info['entries'][0]
-                    else:
-                        video_info = info
-                    
-                    video_id = video_info['id']
-                    title = video_info.get('title', 'Неизвестная песня')
-                    duration = video_info.get('duration', 0)
-                    webpage_url = video_info['webpage_url']
-                    expected_filename = os.path.join('downloads', f"{video_id}.mp3")
-
-                    song_data = {
-                        "filename": expected_filename,
-                        "title": title,
-                        "duration": duration,
-                        "webpage_url": webpage_url,
-                        "requester": ctx.author.mention
-                    }
-
-                    if not os.path.exists(expected_filename):
-                        await loading_msg.edit(content=f"📥 Загружаю `{title}`...")
-                        ydl.download([webpage_url])
+                if is_url and 'youtube.com' in query and 'search_query' in query:
+                    parsed_url = urllib.parse.urlparse(query)
+                    search_query = urllib.parse.parse_qs(parsed_url.query)['search_query'][0]
+                    print(f"[DEBUG] Extracted search query from URL: '{search_query}'")
+                    search_query = f"ytsearch:{search_query}"
+                elif not is_url:
+                    search_query = f"ytsearch:{query}"
 
-                except Exception as e:
-                    print(f"[ERROR] Exception during yt-dlp processing: {e}")
-                    await loading_msg.edit(content=f"❌ Ошибка при обработке запроса: {e}")
+                video_info = await self.lookup_video(search_query, tag)
+                if video_info is None:
+                    await loading_msg.edit(content=f"❌ Ничего не найдено по запросу: `{query}`")
                     return
-            
-            self.last_channel_id = ctx.channel.id
 
-            if self.voice_client and self.voice_client.is_playing():
-                self.song_queue.append(song_data)
+                title = video_info.get('title', 'Неизвестная песня')
+                duration = video_info.get('duration') or 0
+                webpage_url = video_info['webpage_url']
+                song_data = {
+                    "cache_key": cache_key(video_info),
+                    "title": title,
+                    "duration": duration,
+                    "webpage_url": webpage_url,
+                    "acodec": video_info.get('acodec'),
+                    "requester": ctx.author.mention
+                }
+
+                # A song that will wait in the queue is left to the prefetcher.
+                player = self.players.get(ctx.guild.id)
+                will_queue = player and (player.current_song or player.song_queue)
+
+                if PLAYBACK_MODE == "stream":
+                    # Metadata cache hits carry no media URL; start_next_song resolves it then.
+                    if video_info.get('url'):
+                        song_data.update(stream_fields(video_info))
+                elif not will_queue and not self.audio_cache.peek(song_data['cache_key']):
+                    await loading_msg.edit(content=f"📥 Загружаю `{title}`...")
+                    await self.download_to_cache(song_data, tag)
+
+            except Exception as e:
+                print(f"[ERROR] Exception during yt-dlp processing: {e}")
+                await loading_msg.edit(content=f"❌ Ошибка при обработке запроса: {e}")
+                return
+
+            # Looked up again: the player may have been released while we were downloading.
+            player = self.get_player(ctx.guild.id)
+            player.last_channel_id = ctx.channel.id
+
+            # Queued before joining so a pending idle disconnect sees a non-empty queue.
+            busy = player.current_song is not None
+            player.song_queue.append(song_data)
+            self.schedule_prefetch(player)
+            if busy:
+                self.wake_player(player)
                 await loading_msg.edit(content=f"✅ **Добавлено в очередь:** {title}")
             else:
-                if self.voice_client is None or not self.voice_client.is_connected():
-                    self.voice_client = await voice_channel.connect()
-                elif self.voice_client.channel != voice_channel:
-                    await self.voice_client.move_to(voice_channel)
-                
-                self.song_queue.insert(0, song_data)
-                await self.play_next_song()
+                player.cancel_idle_timer()
+                try:
+                    await self.join_channel(player, voice_channel)
+                except Exception:
+                    self.abandon_queue(player, [song_data])
+                    raise
+                self.wake_player(player)
                 await loading_msg.delete()
 
         except Exception as e:
@@ -325,49 +2559,294 @@ class MusicBot(commands.Cog):
             traceback.print_exc()
             await ctx.send(f"❌ Произошла ошибка: {str(e)}")
 
+    async def join_channel(self, player, voice_channel):
+        async with player.join_lock:
+            # An idle disconnect still in progress has to finish before we can connect again.
+            if player.disconnect_task:
+                await asyncio.shield(player.disconnect_task)
+            if player.voice_client is None or not player.voice_client.is_connected():
+                player.voice_client = await voice_channel.connect()
+            elif player.voice_client.channel != voice_channel:
+                await player.voice_client.move_to(voice_channel)
+
+    def abandon_queue(self, player, songs):
+        """
+        Drops the songs one command queued for a voice channel we could not join;
+        songs queued by other commands stay.
+        """
+        player.song_queue.remove_entries(song['entry_id'] for song in songs)
+        self.schedule_prefetch(player)
+        if player.current_song is None and not player.song_queue:
+            self.start_idle_timer(player)
+
+    async def check_user_backlog(self, ctx):
+        """
+        Per-user backpressure: a user whose earlier requests are still being
+        processed is asked to wait instead of queueing more work.
+        """
+        pending = self.ytdl_pool.user_pending.get(ctx.author.mention, 0)
+        if pending < YTDL_USER_MAX_PENDING:
+            return True
+        await ctx.send(f"⏳ У вас уже {pending} запросов в обработке. Дождитесь, пока они завершатся, и попробуйте снова.")
+        return False
+
+    async def fetch_playlist_batch(self, url, start, count, tag):
+        local_ydl_opts = self.ydl_options()
+        local_ydl_opts.update({
+            'extract_flat': 'in_playlist',
+            'noplaylist': False,
+            'playlist_items': f"{start}-{start + count - 1}",
+        })
+        info = await self.ytdl_pool.run(ytdl_extract_info, local_ydl_opts, url, tag=tag)
+        return info.get('title') or "Плейлист", [entry for entry in info.get('entries') or [] if entry]
+
+    async def play_playlist(self, ctx, voice_channel, url, loading_msg):
+        """
+        Queues a playlist from flat extraction. The first small batch is queued
+        and started right away; the rest is read in the background and the
+        progress message is edited at most every PLAYLIST_PROGRESS_INTERVAL seconds.
+        """
+        try:
+            playlist_title, entries = await self.fetch_playlist_batch(
+                url, 1, PLAYLIST_FIRST_BATCH, JobTag(PRIORITY_PLAY, ctx.guild.id, ctx.author.mention)
+            )
+        except Exception as e:
+            print(f"[ERROR] Exception during playlist extraction: {e}")
+            await loading_msg.edit(content=f"❌ Ошибка при обработке плейлиста: {e}")
+            return
+        if not entries:
+            await loading_msg.edit(content=f"❌ Плейлист пуст или недоступен: `{url}`")
+            return
+
+        player = self.get_player(ctx.guild.id)
+        player.last_channel_id = ctx.channel.id
+        player.cancel_playlist()
+        queued = self.enqueue_flat_entries(player, entries, ctx.author.mention)
+        added = len(queued)
+
+        if not player.current_song:
+            player.cancel_idle_timer()
+            try:
+                await self.join_channel(player, voice_channel)
+            except Exception as e:
+                print(f"[ERROR] Could not join voice channel: {e}")
+                self.abandon_queue(player, queued)
+                await loading_msg.edit(content=f"❌ Не удалось подключиться к голосовому каналу: {e}")
+                return
+        self.wake_player(player)
+
+        await loading_msg.edit(content=f"📥 Плейлист **{playlist_title}**: добавлено {added} песен...")
+        if len(entries) < PLAYLIST_FIRST_BATCH:
+            await loading_msg.edit(content=f"✅ Плейлист **{playlist_title}**: добавлено {added} песен")
+            return
+
+        player.playlist_task = self.bot.loop.create_task(
+            self.ingest_playlist(player, url, playlist_title, added, ctx.author.mention, loading_msg)
+        )
+
+    async def ingest_playlist(self, player, url, playlist_title, added, requester, progress_msg):
+        start = PLAYLIST_FIRST_BATCH + 1
+        last_edit = time.monotonic()
+        try:
+            while start <= PLAYLIST_MAX_ITEMS and len(player.song_queue) < MAX_QUEUE_SIZE:
+                count = min(PLAYLIST_BATCH_SIZE, PLAYLIST_MAX_ITEMS - start + 1)
+                tag = JobTag(PRIORITY_BULK, player.guild_id, requester)
+                _, entries = await self.fetch_playlist_batch(url, start, count, tag)
+                added += len(self.enqueue_flat_entries(player, entries, requester))
+                if len(entries) < count:
+                    break
+                start += count
+
+                if time.monotonic() - last_edit >= PLAYLIST_PROGRESS_INTERVAL:
+                    last_edit = time.monotonic()
+                    try:
+                        await progress_msg.edit(content=f"📥 Плейлист **{playlist_title}**: добавлено {added} песен...")
+                    except discord.HTTPException:
+                        pass
+
+            await progress_msg.edit(content=f"✅ Плейлист **{playlist_title}**: добавлено {added} песен")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Playlist ingestion stopped after {added} songs: {e}")
+            try:
+                await progress_msg.edit(content=f"⚠️ Плейлист **{playlist_title}**: добавлено {added} песен, остальные загрузить не удалось")
+            except discord.HTTPException:
+                pass
+        finally:
+            if player.playlist_task is asyncio.current_task():
+                player.playlist_task = None
+                self.release_player(player)
+
+    def enqueue_flat_entries(self, player, entries, requester):
+        queued = []
+        for entry in entries:
+            if len(player.song_queue) >= MAX_QUEUE_SIZE:
+                break
+            if not entry.get('id'):
+                continue
+            song_data = {
+                "cache_key": cache_key({'extractor_key': entry.get('ie_key'), 'id': entry['id']}),
+                "title": entry.get('title') or 'Неизвестная песня',
+                "duration": entry.get('duration') or 0,
+                "webpage_url": entry.get('url') or entry.get('webpage_url'),
+                "acodec": None,
+                "requester": requester,
+                "needs_metadata": True,
+            }
+            player.song_queue.append(song_data)
+            queued.append(song_data)
+        if queued:
+            self.schedule_prefetch(player)
+        return queued
+
     async def previous_song(self, interaction: discord.Interaction):
-        if not self.play_history:
+        player = self.players.get(interaction.guild_id)
+        if not player or not player.play_history:
             await interaction.followup.send("❌ Нет предыдущих песен в истории.", ephemeral=True)
             return
 
-        if self.voice_client and self.voice_client.is_playing():
-            if self.current_song:
-                self.song_queue.insert(0, self.current_song)
+        if player.voice_client and player.voice_client.is_playing():
+            if player.current_song:
+                player.song_queue.appendleft(player.current_song)
 
-        previous_song = self.play_history.pop()
-        self.song_queue.insert(0, previous_song)
+        previous_song = player.play_history.pop()
+        player.song_queue.appendleft(previous_song)
 
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.stop()
+        if player.voice_client and (player.voice_client.is_playing() or player.voice_client.is_paused()):
+            player.voice_client.stop()
         else:
-            await self.play_next_song()
+            self.wake_player(player)
 
         await interaction.followup.send("⏮️ Воспроизвожу предыдущую песню!", ephemeral=True)
 
+    @commands.hybrid_command(name='radio', description='Включить радио: один поток на все серверы')
+    async def radio(self, ctx, *, query: str):
+        print(f"[DEBUG] 'radio' command invoked by {ctx.author} with query: \"{query}\" ")
+        if not ctx.author.voice:
+            await ctx.send("❌ Вы должны находиться в голосовом канале!")
+            return
+        voice_channel = ctx.author.voice.channel
+        if not voice_channel.permissions_for(ctx.guild.me).connect or not voice_channel.permissions_for(ctx.guild.me).speak:
+            await ctx.send("❌ У меня нет прав для подключения или воспроизведения аудио в этом канале!")
+            return
+        player = self.players.get(ctx.guild.id)
+        if player and (player.current_song or player.song_queue):
+            await ctx.send("❌ Сначала остановите музыку командой /stop")
+            return
+        if not await self.check_user_backlog(ctx):
+            return
+
+        loading_msg = await ctx.send(f"📻 Настраиваю радио `{query}`...")
+        try:
+            search_query = query.strip() if query.strip().startswith('http') else f"ytsearch:{query}"
+            video_info = await self.lookup_video(search_query, JobTag(PRIORITY_PLAY, ctx.guild.id, ctx.author.mention))
+            if video_info is None:
+                await loading_msg.edit(content=f"❌ Ничего не найдено по запросу: `{query}`")
+                return
+            station = self.get_station(video_info)
+
+            player = self.get_player(ctx.guild.id)
+            player.last_channel_id = ctx.channel.id
+            player.cancel_idle_timer()
+            try:
+                await self.join_channel(player, voice_channel)
+            except Exception:
+                self.close_station(station)
+                self.start_idle_timer(player)
+                raise
+            self.tune_in(player, station)
+            await loading_msg.edit(content=f"📻 **Радио:** {station.name} (слушателей: {len(station.listeners)})")
+        except Exception as e:
+            print(f"[ERROR] Exception in radio: {e}")
+            await loading_msg.edit(content=f"❌ Не удалось включить радио: {e}")
+
+    def get_station(self, video_info):
+        """
+        Returns the running station for this track, starting one if needed, so
+        every guild that tunes in shares one decoder.
+        """
+        key = cache_key(video_info)
+        station = self.stations.get(key)
+        if station is not None:
+            return station
+        song_data = {
+            "cache_key": key,
+            "title": video_info.get('title', 'Неизвестная песня'),
+            "duration": video_info.get('duration') or 0,
+            "webpage_url": video_info['webpage_url'],
+            "acodec": video_info.get('acodec'),
+        }
+        station = BroadcastSource(
+            song_data['title'],
+            lambda: self.open_station_upstream(song_data),
+            on_empty=lambda station: self.bot.loop.call_soon_threadsafe(self.close_station, station),
+        )
+        station.key = key
+        self.stations[key] = station
+        self.audio_cache.acquire(key)
+        station.start()
+        print(f"[DEBUG] Started radio station {key} ({len(self.stations)} running)")
+        return station
+
+    def open_station_upstream(self, song_data):
+        # Runs on the station's thread; the source is opened on the event loop.
+        return asyncio.run_coroutine_threadsafe(self.open_station_source(song_data), self.bot.loop).result()
+
+    async def open_station_source(self, song_data):
+        if not self.audio_cache.peek(song_data['cache_key']):
+            await self.resolve_stream(song_data, JobTag(PRIORITY_PLAY, None, None))
+        return await self.open_audio_source(song_data)
+
+    def close_station(self, station):
+        if station.listeners or self.stations.get(station.key) is not station:
+            return
+        del self.stations[station.key]
+        station.close()
+        self.audio_cache.release(station.key)
+        print(f"[DEBUG] Closed radio station {station.key} ({len(self.stations)} running)")
+
+    def tune_in(self, player, station):
+        player.radio = station
+        if player.voice_client.is_playing() or player.voice_client.is_paused():
+            player.voice_client.stop()
+        listener = BroadcastListener(station)
+        try:
+            player.voice_client.play(
+                listener,
+                after=lambda e: self.bot.loop.call_soon_threadsafe(self.radio_ended, player, station, e),
+            )
+        except BaseException:
+            # discord.py never saw the listener, so it has to leave the station here.
+            player.radio = None
+            listener.cleanup()
+            raise
+
+    def radio_ended(self, player, station, error):
+        if error:
+            print(f"[ERROR] Radio error in guild {player.guild_id}: {error}")
+        if player.radio is not station:
+            return
+        player.radio = None
+        if not player.current_song and not player.song_queue and player.task is None:
+            self.start_idle_timer(player)
+
     @commands.hybrid_command(name='stop', description='Остановить воспроизведение и очистить очередь')
     async def stop_music(self, ctx):
         print(f"[DEBUG] 'stop' command invoked by {ctx.author}")
-        if self.voice_client:
-            self.song_queue = []
-            self.loop = False
-            self.voice_client.stop()
-            await self.voice_client.disconnect()
-            self.voice_client = None
-            self.current_song = None
+        player = self.players.get(ctx.guild.id)
+        if player and player.voice_client:
+            await self.shutdown_player(player)
             await ctx.send("⏹️ Воспроизведение остановлено и очередь очищена!")
-            if self.now_playing_message:
-                try:
-                    await self.now_playing_message.delete()
-                except discord.NotFound:
-                    pass
         else:
             await ctx.send("❌ Бот не в голосовом канале!")
 
     @commands.hybrid_command(name='pause', description='Приостановить воспроизведение музыки')
     async def pause_music(self, ctx):
         print(f"[DEBUG] 'pause' command invoked by {ctx.author}")
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.pause()
+        player = self.players.get(ctx.guild.id)
+        if player and player.voice_client and player.voice_client.is_playing():
+            player.voice_client.pause()
             await ctx.send("⏸️ Воспроизведение приостановлено!")
         else:
             await ctx.send("❌ Музыка не воспроизводится!")
@@ -375,8 +2854,9 @@ class MusicBot(commands.Cog):
     @commands.hybrid_command(name='resume', description='Возобновить воспроизведение музыки')
     async def resume_music(self, ctx):
         print(f"[DEBUG] 'resume' command invoked by {ctx.author}")
-        if self.voice_client and self.voice_client.is_paused():
-            self.voice_client.resume()
+        player = self.players.get(ctx.guild.id)
+        if player and player.voice_client and player.voice_client.is_paused():
+            player.voice_client.resume()
             await ctx.send("▶️ Воспроизведение возобновлено!")
         else:
             await ctx.send("❌ Музыка не приостановлена!")
@@ -384,26 +2864,19 @@ class MusicBot(commands.Cog):
     @commands.hybrid_command(name='disconnect', description='Отключить бота от голосового канала')
     async def disconnect(self, ctx):
         print(f"[DEBUG] 'disconnect' command invoked by {ctx.author}")
-        if self.voice_client:
-            self.song_queue = []
-            self.loop = False
-            await self.voice_client.disconnect()
-            self.voice_client = None
-            self.current_song = None
+        player = self.players.get(ctx.guild.id)
+        if player and player.voice_client:
+            await self.shutdown_player(player)
             await ctx.send("🔌 Бот отключен от голосового канала!")
-            if self.now_playing_message:
-                try:
-                    await self.now_playing_message.delete()
-                except discord.NotFound:
-                    pass
         else:
             await ctx.send("❌ Бот не подключен к голосовому каналу!")
 
     @commands.hybrid_command(name='nowplaying', description='Показать текущую играющую песню')
     async def now_playing(self, ctx):
         print(f"[DEBUG] 'nowplaying' command invoked by {ctx.author}")
-        if self.current_song and self.voice_client and self.voice_client.is_playing():
-            title = self.current_song['title']
+        player = self.players.get(ctx.guild.id)
+        if player and player.current_song and player.voice_client and player.voice_client.is_playing():
+            title = player.current_song['title']
             await ctx.send(f"🎵 **Сейчас играет:** {title}")
         else:
             await ctx.send("❌ Сейчас ничего не играет!")
@@ -411,8 +2884,9 @@ class MusicBot(commands.Cog):
     @commands.hybrid_command(name='skip', description='Пропустить текущую песню')
     async def skip(self, ctx):
         print(f"[DEBUG] 'skip' command invoked by {ctx.author}")
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.stop()
+        player = self.players.get(ctx.guild.id)
+        if player and player.voice_client and player.voice_client.is_playing():
+            player.voice_client.stop()
             await ctx.send("⏭️ Песня пропущена!")
         else:
             await ctx.send("❌ Нечего пропускать!")
@@ -420,54 +2894,286 @@ class MusicBot(commands.Cog):
     @commands.hybrid_command(name='queue', description='Показать всю очередь песен', aliases=['list'])
     async def queue(self, ctx):
         print(f"[DEBUG] 'queue' command invoked by {ctx.author}")
-        if not self.song_queue:
+        player = self.players.get(ctx.guild.id)
+        if not player or not player.song_queue:
             await ctx.send("🎶 Очередь пуста!")
             return
 
-        embed = discord.Embed(title="🎶 Очередь песен", color=discord.Color.blue())
-        
-        queue_list = ""
-        for i, song in enumerate(self.song_queue):
-            queue_list += f"{i+1}. {song['title']}\n"
-        
-        embed.description = queue_list
+        view = QueueView(self, ctx.guild.id)
+        view.message = await ctx.send(embed=view.render(), view=view)
+
+    def queued_player(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        return player if player and player.song_queue else None
+
+    @commands.hybrid_command(name='remove', description='Удалить песню из очереди по номеру')
+    async def remove(self, ctx, position: int):
+        print(f"[DEBUG] 'remove' command invoked by {ctx.author} with position {position}")
+        player = self.queued_player(ctx)
+        if not player:
+            await ctx.send("🎶 Очередь пуста!")
+            return
+        if not 1 <= position <= len(player.song_queue):
+            await ctx.send(f"❌ Номер должен быть от 1 до {len(player.song_queue)}!")
+            return
+
+        song = player.song_queue.remove_at(position - 1)
+        self.schedule_prefetch(player)
+        await ctx.send(f"🗑️ Удалено из очереди: {song['title']}")
+
+    @commands.hybrid_command(name='move', description='Переместить песню в очереди')
+    async def move(self, ctx, source: int, destination: int):
+        print(f"[DEBUG] 'move' command invoked by {ctx.author}: {source} -> {destination}")
+        player = self.queued_player(ctx)
+        if not player:
+            await ctx.send("🎶 Очередь пуста!")
+            return
+        size = len(player.song_queue)
+        if not 1 <= source <= size or not 1 <= destination <= size:
+            await ctx.send(f"❌ Номера должны быть от 1 до {size}!")
+            return
+
+        song = player.song_queue.move(source - 1, destination - 1)
+        self.schedule_prefetch(player)
+        await ctx.send(f"↕️ {song['title']} теперь на позиции {destination}")
 
+    @commands.hybrid_command(name='skipto', description='Перейти к песне в очереди по номеру')
+    async def skipto(self, ctx, position: int):
+        print(f"[DEBUG] 'skipto' command invoked by {ctx.author} with position {position}")
+        player = self.queued_player(ctx)
+        if not player or not player.voice_client:
+            await ctx.send("❌ Нечего пропускать!")
+            return
+        if not 1 <= position <= len(player.song_queue):
+            await ctx.send(f"❌ Номер должен быть от 1 до {len(player.song_queue)}!")
+            return
+
+        player.song_queue.skip_to(position - 1)
+        title = player.song_queue[0]['title']
+        if player.voice_client.is_playing() or player.voice_client.is_paused():
+            player.voice_client.stop()
+        else:
+            self.wake_player(player)
+        await ctx.send(f"⏭️ Переход к: {title}")
+
+    @commands.hybrid_command(name='shuffle', description='Перемешать очередь песен')
+    async def shuffle(self, ctx):
+        print(f"[DEBUG] 'shuffle' command invoked by {ctx.author}")
+        player = self.queued_player(ctx)
+        if not player:
+            await ctx.send("🎶 Очередь пуста!")
+            return
+
+        player.song_queue.shuffle()
+        self.schedule_prefetch(player)
+        await ctx.send("🔀 Очередь перемешана!")
+
+    @commands.hybrid_command(name='sync', description='Принудительно синхронизировать slash-команды')
+    @commands.is_owner()
+    async def sync_commands(self, ctx):
+        print(f"[DEBUG] 'sync' command invoked by {ctx.author}")
+        synced_scopes = await sync_command_tree(force=True)
+        await ctx.send(f"✅ Синхронизировано областей: {synced_scopes}")
+
+    @commands.hybrid_command(name='stats', description='Показать статистику бота')
+    @commands.is_owner()
+    async def stats(self, ctx):
+        print(f"[DEBUG] 'stats' command invoked by {ctx.author}")
+        pool = self.ytdl_pool.stats()
+        embed = discord.Embed(title="📊 Статистика", color=discord.Color.blue())
+        embed.add_field(name="Серверов с плеером", value=str(len(self.players)))
+        embed.add_field(
+            name=f"yt-dlp ({pool['kind']}, {pool['workers']} воркеров)",
+            value=(
+                f"В очереди: {pool['pending']} от {pool['users']} пользователей\n"
+                f"Ждут воркера: сейчас {pool['waiting'][PRIORITY_PLAY]}, "
+                f"предзагрузка {pool['waiting'][PRIORITY_PREFETCH]}, фон {pool['waiting'][PRIORITY_BULK]}\n"
+                f"Выполнено: {pool['completed']} (ошибок: {pool['failed']})\n"
+                f"Ожидание: {pool['wait_avg']:.2f}с сред. / {pool['wait_max']:.2f}с макс.\n"
+                f"Выполнение: {pool['exec_avg']:.2f}с сред. / {pool['exec_max']:.2f}с макс."
+            ),
+            inline=False,
+        )
+        cache = self.audio_cache.stats()
+        embed.add_field(
+            name="Кэш аудио",
+            value=(
+                f"Файлов: {cache['files']} ({cache['size_mb']:.0f} / {cache['max_mb']:.0f} МБ)\n"
+                f"Попаданий: {cache['hits']}, промахов: {cache['misses']} ({cache['hit_rate']:.0%})\n"
+                f"Вытеснено: {cache['evictions']}"
+            ),
+            inline=False,
+        )
+        ffmpeg = self.ffmpeg_budget.stats()
+        embed.add_field(
+            name=f"FFmpeg (максимум {ffmpeg['max']} процессов)",
+            value=(
+                f"Воспроизведение: {ffmpeg['live_running']} работает, {ffmpeg['live_waiting']} ждёт\n"
+                f"Конвертация: {ffmpeg['background_running']} работает, {ffmpeg['background_waiting']} ждёт"
+            ),
+            inline=False,
+        )
+        metadata = await self.metadata_cache.run(self.metadata_cache.stats)
+        embed.add_field(
+            name="Кэш метаданных",
+            value=(
+                f"Записей: {metadata['entries']}\n"
+                f"Попаданий: {metadata['hits']}, промахов: {metadata['misses']} ({metadata['hit_rate']:.0%})\n"
+                f"Обновлено в фоне: {metadata['refreshes']}"
+            ),
+            inline=False,
+        )
+        queues = await self.queue_store.run(self.queue_store.stats)
+        embed.add_field(
+            name="Сохранённые очереди",
+            value=(
+                f"Серверов: {queues['guilds']}\n"
+                f"Записей в базу: {queues['writes']} ({queues['write_avg'] * 1000:.1f}мс сред.)"
+            ),
+            inline=False,
+        )
+        if self.stations:
+            lines = []
+            for station in self.stations.values():
+                info = station.stats()
+                lines.append(
+                    f"{station.name}: слушателей {info['listeners']}, "
+                    f"пустых кадров {info['underruns']}, отставшим пропущено {info['skipped']} пакетов"
+                )
+            embed.add_field(name="Радио", value="\n".join(lines), inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name='cluster', description='Показать состояние всех процессов бота')
+    @commands.is_owner()
+    async def cluster_status(self, ctx):
+        print(f"[DEBUG] 'cluster' command invoked by {ctx.author}")
+        if self.cluster is None:
+            await ctx.send("❌ Бот запущен без launcher.py или связь с ним потеряна")
+            return
+        workers = await self.cluster.request('cluster_stats', timeout=10)
+        embed = discord.Embed(title="🧩 Кластер", color=discord.Color.blue())
+        for worker in workers:
+            if not worker.get('online'):
+                embed.add_field(name=f"Процесс {worker['cluster_id']}", value="❌ Недоступен", inline=False)
+                continue
+            embed.add_field(
+                name=f"Процесс {worker['cluster_id']} (шарды {', '.join(map(str, worker['shard_ids']))})",
+                value=(
+                    f"Серверов: {worker['guilds']}, плееров: {worker['players']}, в голосе: {worker['voice']}\n"
+                    f"Радиостанций: {worker['stations']}, FFmpeg: {worker['ffmpeg_running']}, "
+                    f"yt-dlp в очереди: {worker['ytdl_pending']}\n"
+                    f"Задержка: {worker['latency'] * 1000:.0f}мс"
+                ),
+                inline=False,
+            )
         await ctx.send(embed=embed)
 
+    @commands.hybrid_command(name='restart_worker', description='Перезапустить процесс бота')
+    @commands.is_owner()
+    async def restart_worker(self, ctx, worker: int):
+        print(f"[DEBUG] 'restart_worker' command invoked by {ctx.author} for worker {worker}")
+        if self.cluster is None:
+            await ctx.send("❌ Бот запущен без launcher.py или связь с ним потеряна")
+            return
+        if await self.cluster.request('restart_worker', cluster_id=worker):
+            await ctx.send(f"🔄 Процесс {worker} перезапускается")
+        else:
+            await ctx.send(f"❌ Процесс {worker} не найден или недоступен")
+
     @commands.hybrid_command(name='clear', description='Очистить очередь песен')
     async def clear(self, ctx):
         print(f"[DEBUG] 'clear' command invoked by {ctx.author}")
-        self.song_queue = []
+        player = self.players.get(ctx.guild.id)
+        if player:
+            player.cancel_playlist()
+            player.cancel_restore()
+            player.song_queue.clear()
+            player.cancel_prefetches()
         await ctx.send("🗑️ Очередь очищена!")
 
-async def setup(bot, ffmpeg_executable):
-    await bot.add_cog(MusicBot(bot, ffmpeg_executable))
+async def setup(bot, ffmpeg_setup):
+    await bot.add_cog(MusicBot(bot, ffmpeg_setup))
 
 @bot.event
 async def on_ready():
     print(f'[INFO] 🤖 Бот {bot.user} готов к работе!')
     print(f'[INFO] 📊 Подключен к {len(bot.guilds)} серверам')
+    log_cache_savings()
+    # Global commands belong to the application, not to a shard, so in a cluster only
+    # the first worker syncs them.
+    if CLUSTER_ID == 0:
+        await sync_command_tree()
+
+def command_tree_hash(guild=None):
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)]
+    payload.sort(key=lambda command: (command.get('type', 1), command['name']))
+    schema = json.dumps([bot.application_id, payload], sort_keys=True, default=str)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+def load_sync_hashes():
     try:
-        synced = await bot.tree.sync()
-        print(f'[INFO] ✅ Синхронизировано {len(synced)} команд')
-    except Exception as e:
-        print(f'[ERROR] ❌ Ошибка синхронизации команд: {e}')
+        with open(COMMAND_SYNC_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-async def main():
-    load_dotenv()
-    ffmpeg_executable = setup_ffmpeg()
-    if not ffmpeg_executable:
+def save_sync_hashes(hashes):
+    os.makedirs(os.path.dirname(COMMAND_SYNC_FILE) or '.', exist_ok=True)
+    tmp_path = COMMAND_SYNC_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, COMMAND_SYNC_FILE)
+
+async def sync_command_tree(force=False):
+    """
+    Syncs the global command tree, and a copy of it to every DEV_GUILD_IDS guild,
+    when its schema hash differs from the stored one (or always with force).
+    Returns the number of scopes that were synced.
+    """
+    hashes = load_sync_hashes()
+    scopes = [(None, 'global')] + [(discord.Object(id=guild_id), str(guild_id)) for guild_id in DEV_GUILD_IDS]
+    synced_scopes = 0
+    for guild, scope in scopes:
+        if guild is not None:
+            bot.tree.copy_global_to(guild=guild)
+        schema_hash = command_tree_hash(guild)
+        if not force and hashes.get(scope) == schema_hash:
+            continue
+        try:
+            synced = await bot.tree.sync(guild=guild)
+        except Exception as e:
+            print(f'[ERROR] ❌ Ошибка синхронизации команд ({scope}): {e}')
+            continue
+        hashes[scope] = schema_hash
+        synced_scopes += 1
+        print(f'[INFO] ✅ Синхронизировано {len(synced)} команд ({scope})')
+    if synced_scopes:
+        save_sync_hashes(hashes)
+    else:
+        print('[INFO] Команды не изменились, синхронизация не нужна')
+    return synced_scopes
+
+async def watch_ffmpeg_setup(ffmpeg_setup):
+    if not await ffmpeg_setup:
         print("[FATAL] Завершение работы из-за ошибки с FFmpeg.")
-        return
+        await bot.close()
 
+async def main():
     async with bot:
-        await setup(bot, ffmpeg_executable)
         TOKEN = os.environ.get("DISCORD_TOKEN")
         if not TOKEN:
             print("❌ Токен бота не найден! Пожалуйста, создайте файл .env и добавьте в него DISCORD_TOKEN=ВАШ_ТОКЕН")
             return
-        
-        await bot.start(TOKEN)
+
+        # FFmpeg is located (or downloaded and extracted) in a thread while the bot
+        # logs in; playback waits for it in MusicBot.wait_for_ffmpeg.
+        ffmpeg_setup = asyncio.get_running_loop().run_in_executor(None, setup_ffmpeg)
+        ffmpeg_watch = asyncio.create_task(watch_ffmpeg_setup(ffmpeg_setup))
+        await setup(bot, ffmpeg_setup)
+        try:
+            await bot.start(TOKEN)
+        finally:
+            ffmpeg_watch.cancel()
 
 if __name__ == "__main__":
     asyncio.run(main())